@@ -0,0 +1,266 @@
+"""渲染性能基准：在本地生成合成歌曲，分阶段测量渲染性能，结果可保存为 JSON 供不同提交之间比较。
+
+阶段: wrap_text（歌词换行）、background（动态背景）、cover（封面）、lyrics（歌词图层）、
+compose（逐帧合成整首歌，不编码，并记录首秒之后峰值内存的增长）、render（完整渲染+编码）。
+每个阶段在独立的子进程中运行，峰值内存互不影响，并使用各自的空缓存；随机数种子固定，同样的参数总是生成同样的输入。
+
+用法: python benchmark.py [--duration 秒数] [--langs zh ja en] [--lines 行数] [--cover-size 像素]
+                          [--stages ...] [--encoders ffmpeg moviepy] [--output 结果.json] [--compare 基线.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+import video_generator as vg
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不统计峰值内存
+    resource = None
+
+WORDS = {
+    "en": ["love", "night", "city", "dream", "light", "falling", "together", "forever", "summer", "rain",
+           "heart", "shadow", "remember", "tonight", "endless", "morning"],
+    "zh": list("我你他的是在有不这人们来到时大地为子中说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动"),
+    "ja": ["あなた", "わたし", "夜空", "きらきら", "光る", "夢を", "見た", "ずっと", "一緒に", "風が",
+           "吹いて", "届かない", "想い", "さくら", "キミと", "未来へ"],
+}
+SEPARATORS = {"en": " ", "zh": "", "ja": ""}
+STAGES = ["wrap_text", "background", "cover", "lyrics", "compose", "render"]
+
+
+def make_synthetic_song(work_dir, duration, lang="en", num_lines=None, cover_size=3000, seed=0):
+    """生成正弦波音频、指定语言的随机 LRC 和大尺寸封面，返回 (音频, 歌词, 封面) 路径。"""
+    audio_path = os.path.join(work_dir, "bench.mp3")
+    lyrics_path = os.path.join(work_dir, f"bench_{lang}.lrc")
+    cover_path = os.path.join(work_dir, f"bench_{cover_size}.jpg")
+    if not os.path.exists(audio_path):
+        subprocess.run([vg.ffmpeg_binary(), "-y", "-loglevel", "error", "-f", "lavfi",
+                        "-i", f"sine=frequency=440:duration={duration}", audio_path], check=True)
+
+    rng = np.random.default_rng(seed)
+    words = WORDS[lang]
+    num_lines = num_lines or max(1, int(duration / 3))
+    with open(lyrics_path, "w", encoding="utf-8") as f:
+        for i in range(num_lines):
+            t = i * duration / num_lines
+            text = SEPARATORS[lang].join(rng.choice(words, size=rng.integers(3, 16)))
+            f.write(f"[{int(t // 60):02d}:{t % 60:05.2f}]{text}\n")
+
+    if not os.path.exists(cover_path):
+        # 低分辨率噪声放大成平滑的色块，接近真实封面的压缩率与模糊开销
+        noise = Image.fromarray(rng.integers(0, 256, (48, 48, 3), dtype=np.uint8))
+        noise.resize((cover_size, cover_size), Image.BICUBIC).save(cover_path, quality=90)
+    return audio_path, lyrics_path, cover_path
+
+
+def peak_rss_mb():
+    """本进程与已结束子进程（ffmpeg）的峰值常驻内存，单位 MB；不支持的平台返回 None。"""
+    if resource is None: return None, None
+    scale = 1 / (1 << 20) if sys.platform == "darwin" else 1 / 1024  # macOS 以字节计，Linux 以 KB 计
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1))
+
+
+def frame_stats(get_frame, times):
+    started = time.perf_counter()
+    for t in times: get_frame(t)
+    seconds = time.perf_counter() - started
+    return {"frames": len(times), "seconds": seconds, "fps": len(times) / seconds,
+            "ms_per_frame": seconds / len(times) * 1000}
+
+
+def load_song(song):
+    """按正式渲染的方式解析歌词、检测语言并加载字体。"""
+    layout = vg.render_layout()
+    lyrics = vg.parse_lyrics(song["lyrics_path"], song["duration"])
+    lang = vg.detect_language(" ".join(l["text"] for l in lyrics))
+    return layout, lyrics, lang, vg.load_fonts(lang, "Fonts", *layout["font_sizes"])
+
+
+def stage_caches(song):
+    """每个阶段在 work_dir 中使用一份新的空缓存，结果不受之前的运行留在 CACHE_DIR 中的缓存影响。"""
+    cache_dir = tempfile.mkdtemp(prefix="cache_", dir=song["work_dir"])
+    return vg.ArrayDiskCache(cache_dir), vg.SegmentationCache(os.path.join(cache_dir, "jieba_segments.json"))
+
+
+def bench_wrap_text(song, times, encoder):
+    layout, lyrics, lang, fonts = load_song(song)
+    _, segmenter = stage_caches(song)
+    started = time.perf_counter()
+    for lyric in lyrics:
+        vg.wrap_text(lyric["text"], fonts["bold"], layout["lyrics"]["area_width"], lang, segmenter)
+    seconds = time.perf_counter() - started
+    return {"calls": len(lyrics), "seconds": seconds, "ms_per_call": seconds / len(lyrics) * 1000}
+
+
+def bench_background(song, times, encoder):
+    layout = vg.render_layout()
+    started = time.perf_counter()
+    clip = vg.create_dynamic_background(song["cover_path"], song["duration"], layout["video_size"],
+                                        layout["blur_radius"])
+    return dict(frame_stats(clip.get_frame, times), setup_seconds=time.perf_counter() - started)
+
+
+def bench_cover(song, times, encoder):
+    layout = vg.render_layout()
+    started = time.perf_counter()
+    clip = vg.create_cover_clip(song["cover_path"], song["duration"], layout["video_size"], layout["cover_size"],
+                                layout["cover_pos"], layout["corner_radius"])
+    return dict(frame_stats(clip.get_frame, times), setup_seconds=time.perf_counter() - started)
+
+
+def bench_lyrics(song, times, encoder):
+    _, segmenter = stage_caches(song)
+    started = time.perf_counter()
+    layout, lyrics, lang, fonts = load_song(song)
+    wrapped = vg.wrap_lyrics(lyrics, fonts["bold"], lang, layout["lyrics"]["area_width"], segmenter)
+    clip = vg.create_lyrics_clip(lyrics, song["duration"], fonts, lang, layout["lyrics"], wrapped=wrapped)
+    return dict(frame_stats(clip.get_frame, times), setup_seconds=time.perf_counter() - started)
+
+
+def bench_compose(song, times, encoder):
+    array_cache, segmenter = stage_caches(song)
+    started = time.perf_counter()
+    compose_frame, clips = vg.build_render_pipeline(song["lyrics_path"], song["cover_path"], song["duration"],
+                                                    array_cache=array_cache, segmenter=segmenter)
+    setup_seconds = time.perf_counter() - started
+    all_times = [n / vg.FPS for n in range(int(song["duration"] * vg.FPS))]
+    for t in all_times[:vg.FPS]: compose_frame(t)  # 第一秒用于预热缓存与缓冲，之后峰值内存应保持不变
+    warm_rss = peak_rss_mb()[0]
+    result = frame_stats(compose_frame, all_times[vg.FPS:])
+    end_rss = peak_rss_mb()[0]
+    result["rss_growth_mb"] = None if warm_rss is None else round(end_rss - warm_rss, 1)
+    return dict(result, setup_seconds=setup_seconds)
+
+
+def bench_render(song, times, encoder):
+    output_path = os.path.join(song["work_dir"], f"out_{song['lang']}_{encoder}.mp4")
+    array_cache, segmenter = stage_caches(song)
+    stats = vg.generate_music_video(song["audio_path"], song["lyrics_path"], song["cover_path"], output_path,
+                                    encoder=encoder, profile=song["profile"],
+                                    render_workers=song["render_workers"], render_plan=False,  # 每次都完整编译
+                                    array_cache=array_cache, segmenter=segmenter)
+    width, height = vg.render_layout()["video_size"]
+    result = {"frames": stats["frames"], "seconds": stats["seconds"], "fps": stats["fps"],
+              "ms_per_frame": stats["seconds"] / stats["frames"] * 1000,
+              "first_frame_seconds": stats.get("first_frame_seconds"),  # 多进程渲染不统计首帧
+              "encode_mb_per_s": stats["frames"] * width * height * 3 / stats["seconds"] / 1e6,  # 送入编码器的 RGB 数据量
+              "output_mb": os.path.getsize(output_path) / 1e6}
+    if "profile" in stats: result["profile"] = stats["profile"]
+    if "ring" in stats: result["ring"] = stats["ring"]
+    return result
+
+
+STAGE_FUNCTIONS = {"wrap_text": bench_wrap_text, "background": bench_background, "cover": bench_cover,
+                   "lyrics": bench_lyrics, "compose": bench_compose, "render": bench_render}
+
+
+def run_stage(stage, song, times, encoder):
+    """在子进程中执行：屏蔽渲染过程中的打印，返回指标与本进程的峰值内存。"""
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            result = STAGE_FUNCTIONS[stage](song, times, encoder)
+        finally:
+            sys.stdout = stdout
+    result["peak_rss_mb"], result["peak_child_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(stage, song, times, encoder=None):
+    # spawn 保证每个阶段都从干净的进程开始，峰值内存和缓存状态不受前一阶段影响
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        result = pool.submit(run_stage, stage, song, times, encoder).result()
+    return dict({"stage": stage, "lang": song["lang"], "encoder": encoder}, **result)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result["stage"], result["lang"], result["encoder"]
+
+
+def print_results(results, baseline=None):
+    baseline = {result_key(r): r for r in (baseline or [])}
+    print("\n阶段        语言  编码器     帧数/次数   帧率(fps)   毫秒/帧   峰值内存(MB)   相对基线")
+    for r in results:
+        count = r.get("frames", r.get("calls"))
+        per_item = r.get("ms_per_frame", r.get("ms_per_call"))
+        rate = f"{r['fps']:.1f}" if "fps" in r else "-"
+        rss = f"{r['peak_rss_mb']:.0f}" if r["peak_rss_mb"] is not None else "-"
+        base = baseline.get(result_key(r))
+        ratio = f"{base.get('ms_per_frame', base.get('ms_per_call')) / per_item:.2f}x" if base else ""
+        print(f"{r['stage']:<11} {r['lang']:<5} {r['encoder'] or '-':<10} {count:>9} {rate:>11} "
+              f"{per_item:>9.2f} {rss:>14} {ratio:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="歌词视频渲染基准")
+    parser.add_argument("--duration", type=float, default=20, help="合成歌曲时长（秒）")
+    parser.add_argument("--langs", nargs="+", default=["zh", "ja", "en"], choices=list(WORDS))
+    parser.add_argument("--lines", type=int, default=None, help="歌词行数（默认每 3 秒一行）")
+    parser.add_argument("--cover-size", type=int, default=3000, help="封面边长（像素）")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--encoders", nargs="+", default=list(vg.ENCODER_BACKENDS), choices=list(vg.ENCODER_BACKENDS))
+    parser.add_argument("--frames", type=int, default=120, help="单图层阶段抽样渲染的帧数")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果比较（按 毫秒/帧 计算加速比）")
+    parser.add_argument("--profile", action="store_true", help="完整渲染时记录各阶段耗时分布并写入结果")
+    parser.add_argument("--render-workers", type=int, default=1,
+                        help="完整渲染时合成画面的进程数（大于 1 时经共享内存帧环交给编码器）")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="lyric_bench_") as work_dir:
+        frame_count = int(args.duration * vg.FPS)
+        times = [n / vg.FPS for n in np.linspace(0, frame_count, min(args.frames, frame_count), endpoint=False).astype(int)]
+        for lang in args.langs:
+            if not all(os.path.exists(path) for path in vg.font_paths(lang, "Fonts").values()):
+                print(f"跳过 {lang}：Fonts 文件夹中缺少 {vg.FONT_MAP[lang]} 字体")
+                continue
+            audio_path, lyrics_path, cover_path = make_synthetic_song(work_dir, args.duration, lang, args.lines,
+                                                                      args.cover_size)
+            song = {"lang": lang, "duration": args.duration, "audio_path": audio_path, "lyrics_path": lyrics_path,
+                    "cover_path": cover_path, "work_dir": work_dir, "profile": args.profile,
+                    "render_workers": args.render_workers}
+            for stage in args.stages:
+                for encoder in (args.encoders if stage == "render" else [None]):
+                    print(f"运行 {stage} ({lang}{', ' + encoder if encoder else ''})...", flush=True)
+                    results.append(run_isolated(stage, song, times, encoder))
+
+    print_results(results, baseline)
+    if args.output:
+        report = {
+            "meta": {"revision": git_revision(), "timestamp": datetime.now().isoformat(),
+                     "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                     "cpu_count": os.cpu_count(), "args": vars(args)},
+            "results": results
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
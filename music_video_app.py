@@ -1,23 +1,64 @@
+import time
+STARTED = time.perf_counter()  # 启动计时起点，尽量早于其他导入
 import sys
 import os
+import importlib.util
+import threading
 import glob
 import re
+import queue
 import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QLabel, QProgressBar, QFileDialog, QFrame,
                              QTextEdit, QSlider, QMessageBox, QLineEdit, QListWidget,
-                             QStackedWidget, QListWidgetItem, QGraphicsDropShadowEffect)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QUrl, QPropertyAnimation, QEasingCurve
-from PyQt5.QtGui import QIcon, QPixmap, QPainter, QFont, QColor, QPainterPath, QPen
+                             QStackedWidget, QListWidgetItem, QGraphicsDropShadowEffect, QComboBox,
+                             QSpinBox, QCheckBox)
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal, QUrl, QPropertyAnimation, QEasingCurve
+from PyQt5.QtGui import QIcon, QPixmap, QPainter, QFont, QColor, QPen, QPolygonF, QDesktopServices
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 
-try:
-    from video_generator import generate_music_video
-except ImportError:
+# 渲染引擎（moviepy、jieba 等）导入较慢，启动时只确认它存在，真正导入推迟到窗口显示之后
+if importlib.util.find_spec("video_generator") is None:
     QMessageBox.critical(None, "错误", "无法找到 'video_generator.py'。\n请确保它与本程序在同一个文件夹下。")
     sys.exit()
 
+
+def load_video_generator():
+    """首次需要时导入渲染引擎；重复调用直接返回已加载的模块。"""
+    import video_generator
+    return video_generator
+
+
+def warm_up_engine(on_ready=None):
+    """在后台线程中导入渲染引擎并加载 jieba 词典，使首次渲染不必再等待。"""
+    def load():
+        engine = load_video_generator()
+        engine.warm_up_segmenter(background=False)
+        if on_ready: on_ready()
+
+    thread = threading.Thread(target=load, name="engine-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+# 输出规格，名称与 video_generator.OUTPUT_PROFILES 一致；只勾选 720p 时输出与以前相同的单个文件
+OUTPUT_PROFILE_CHOICES = [("1080p", "1080p 横屏"), ("720p", "720p 横屏"), ("vertical", "9:16 竖屏")]
+
+
+class StartupTimer:
+    """记录启动各阶段距进程启动的耗时；更细的逐模块导入耗时可用 python -X importtime 查看。"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def mark(self, label):
+        if self.enabled:
+            print(f"[启动计时] {label}: {(time.perf_counter() - STARTED) * 1000:.0f} ms", flush=True)
+
 # --- 1. 全新 Apple 风格样式表 (QSS) ---
 STYLE_SHEET = """
     #MainWindow {
@@ -182,53 +223,179 @@ class WaveformWidget(QWidget):
         self.setMinimumHeight(80)
         self.setObjectName("WaveformFrame")
         self.wave_data = np.array([])
+        self.pyramid = []
+        self.peak = 0.0
+        self.playhead = None  # 播放位置占总时长的比例，None 表示不显示
+        self._pixmap = None  # 预先画好的波形，只在数据或尺寸变化时重建
+
+    def set_waveform(self, pyramid):
+        """pyramid 为峰值金字塔（由细到粗的 (n, 2) [最小值, 最大值] 数组列表），None 表示清空。"""
+        self.pyramid = pyramid or []
+        self.peak = float(np.abs(self.pyramid[-1].astype(np.float32)).max()) if self.pyramid else 0.0
+        self._select_level()
+        self.update()
 
-    def set_waveform(self, data):
-        if data is None or data.size == 0:
+    def set_playhead(self, fraction):
+        """移动播放头，只重绘新旧两条竖线所在的窄条。"""
+        old_x = self._playhead_x()
+        self.playhead = fraction
+        new_x = self._playhead_x()
+        if old_x == new_x: return
+        for x in (old_x, new_x):
+            if x is not None: self.update(x - 2, 0, 4, self.height())
+
+    def _playhead_x(self):
+        if self.playhead is None or self.wave_data.size == 0: return None
+        return int(round(min(max(self.playhead, 0.0), 1.0) * (self.width() - 1)))
+
+    def _select_level(self):
+        """取点数不少于控件宽度两倍的最粗一层，再按列取最大值归约到恰好这么多点。"""
+        num_samples = self.width() * 2
+        if not self.pyramid or self.peak == 0 or num_samples <= 0:
             self.wave_data = np.array([])
-        else:
-            max_val = np.max(np.abs(data));
-            data = np.abs(data) / max_val if max_val != 0 else data
-            num_samples = self.width() * 2
-            if data.size > num_samples and num_samples > 0:
-                step = data.size // num_samples
-                data = data[::step]
-            self.wave_data = data
-        self.update()
+            return
+        level = next((lvl for lvl in reversed(self.pyramid) if len(lvl) >= num_samples), self.pyramid[0])
+        data = np.abs(level.astype(np.float32)).max(axis=1) / self.peak
+        if data.size > num_samples:
+            data = np.maximum.reduceat(data, np.linspace(0, data.size, num_samples, endpoint=False).astype(int))
+        self.wave_data = data
+        self._pixmap = None
 
-    def paintEvent(self, event):
-        painter = QPainter(self)
+    def resizeEvent(self, event):
+        self._select_level()
+        super().resizeEvent(event)
+
+    def _polyline(self, scale):
+        """由 NumPy 一次算出全部顶点，直接写进 QPolygonF 的内存，不逐点调用 Qt。"""
+        h, w, num_points = self.height(), self.width(), self.wave_data.size
+        points = np.empty((num_points + 1, 2))
+        points[0] = (0, h / 2)
+        points[1:, 0] = np.arange(num_points) * (w / num_points)
+        points[1:, 1] = h / 2 + self.wave_data * scale
+        polygon = QPolygonF(len(points))
+        buffer = polygon.data()
+        buffer.setsize(points.nbytes)
+        np.frombuffer(buffer, dtype=np.float64).reshape(points.shape)[:] = points
+        return polygon
+
+    def _render_pixmap(self):
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(self.size() * ratio)
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
         painter.setRenderHint(QPainter.Antialiasing)
+        h = self.height()
+        painter.setPen(QPen(QColor("#3498DB"), 2))
+        painter.drawPolyline(self._polyline(-h / 2.2))
+        painter.setPen(QPen(QColor("#A9CCE3"), 2))
+        painter.drawPolyline(self._polyline(h / 2.2 * 0.4))
+        painter.end()
+        return pixmap
+
+    def paintEvent(self, event):
         if self.wave_data.size == 0: return
+        if self._pixmap is None: self._pixmap = self._render_pixmap()
+        painter = QPainter(self)
+        painter.drawPixmap(0, 0, self._pixmap)
+        x = self._playhead_x()
+        if x is not None:
+            painter.setPen(QPen(QColor("#1D1D1F"), 1))
+            painter.drawLine(x, 0, x, self.height())
 
-        pen = QPen(QColor("#3498DB"), 2);
-        painter.setPen(pen)
-        path = QPainterPath();
-        h, w, num_points = self.height(), self.width(), self.wave_data.size
-        path.moveTo(0, h / 2)
-        for i, val in enumerate(self.wave_data): path.lineTo((i / num_points) * w, h / 2 - val * (h / 2.2))
-        painter.drawPath(path)
-        path_rev = QPainterPath();
-        path_rev.moveTo(0, h / 2)
-        for i, val in enumerate(self.wave_data): path_rev.lineTo((i / num_points) * w, h / 2 + val * (h / 2.2) * 0.4)
-        pen.setColor(QColor("#A9CCE3"));
-        painter.setPen(pen)
-        painter.drawPath(path_rev)
+
+class WaveformThread(QThread):
+    ready = pyqtSignal(str, object)
+
+    def __init__(self, audio_path):
+        super().__init__()
+        self.audio_path = audio_path
+        self._is_cancelled = False
+
+    def run(self):
+        try:
+            pyramid = load_video_generator().load_waveform_pyramid(self.audio_path,
+                                                                  cancelled=lambda: self._is_cancelled)
+        except Exception as e:
+            if not self._is_cancelled: print(f"提取波形失败: {e}")
+            pyramid = None
+        if not self._is_cancelled: self.ready.emit(self.audio_path, pyramid)
+
+    def cancel(self):
+        self._is_cancelled = True
 
 
 class VideoGenerationThread(QThread):
     task_started = pyqtSignal(dict)
     progress = pyqtSignal(int, str)
     finished_signal = pyqtSignal(str)
+    cancelled_signal = pyqtSignal(str)
     error = pyqtSignal(str)
 
-    def __init__(self, tasks):
+    def __init__(self, tasks, core_budget=None, incremental=True):
         super().__init__()
         self.tasks = tasks
+        self.core_budget = core_budget or os.cpu_count() or 1
+        self.incremental = incremental
+        self.skipped = 0
+        self.completed = 0
+        self._render_keys = [None] * len(tasks)
         self._is_cancelled = False
 
     def run(self):
+        if self.incremental: self._skip_unchanged_tasks()
+        if not self.tasks:
+            self.finished_signal.emit(f"全部 {self.skipped} 个任务均未变化，已跳过。")
+            return
+        workers, threads = load_video_generator().plan_core_budget(len(self.tasks), self.core_budget)
+        if workers == 1:
+            self._run_sequential(threads)
+        else:
+            self._run_concurrent(workers, threads)
+
+    def _skip_unchanged_tasks(self):
+        """按内容键比对 history.json，输出已存在且输入与设置都未变化的任务直接跳过。"""
+        engine = load_video_generator()
+        history = engine.load_render_history()
+        remaining, keys = [], []
+        for task in self.tasks:
+            try:
+                key, inputs = engine.compute_render_key(task, history)
+            except OSError:
+                key = inputs = None
+            if key and engine.find_current_render(task, key, history):
+                self.skipped += 1
+                self.progress.emit(0, f"未变化，跳过: {task.get('name', 'video')}")
+                continue
+            remaining.append(task)
+            keys.append((key, inputs) if key else None)
+        self.tasks, self._render_keys = remaining, keys
+
+    def _record_success(self, i):
+        self.completed += 1
+        if not self._render_keys[i]: return
+        try:
+            load_video_generator().record_render(self.tasks[i], *self._render_keys[i])
+        except OSError as e:
+            print(f"写入渲染记录失败: {e}")
+
+    def _finished_message(self, failed=0):
+        total_tasks = len(self.tasks) + self.skipped
+        message = f"全部 {total_tasks} 个任务已完成，其中 {failed} 个失败。" if failed \
+            else f"全部 {total_tasks} 个任务已成功完成！"
+        if self.skipped: message += f"（{self.skipped} 个未变化，已跳过）"
+        return message
+
+    def _emit_finished(self, failed=0):
+        if self._is_cancelled:
+            self.cancelled_signal.emit(f"已取消。{self.completed} 个任务已完成，未完成的输出文件已删除。")
+        else:
+            self.finished_signal.emit(self._finished_message(failed))
+
+    def _run_sequential(self, threads):
+        engine = load_video_generator()
         total_tasks = len(self.tasks)
+        failed = 0
         for i, task in enumerate(self.tasks):
             if self._is_cancelled: break
             self.task_started.emit(task)
@@ -243,13 +410,71 @@ class VideoGenerationThread(QThread):
                     'cover_path': task['cover_path'],
                     'output_path': task['output_path'],
                 }
-                generate_music_video(**args_for_generator, progress_callback=lambda p, m: self.progress.emit(p,
-                                                                                                             f"({i + 1}/{total_tasks}) {m}"))
+                engine.generate_music_video(**args_for_generator, **task.get('render_options', {}), threads=threads,
+                                            progress_callback=lambda p, m: self.progress.emit(p, f"({i + 1}/{total_tasks}) {m}"),
+                                            cancelled=lambda: self._is_cancelled)
+            except engine.Cancelled:
+                break
             except Exception as e:
+                failed += 1
                 self.error.emit(f"处理 '{song_name}' 时出错: {e}")
                 continue
-        if not self._is_cancelled:
-            self.finished_signal.emit(f"全部 {total_tasks} 个任务已成功完成！")
+            self._record_success(i)
+        self._emit_finished(failed)
+
+    def _run_concurrent(self, workers, threads):
+        """在进程池中同时渲染多首歌；子进程的开始/进度事件经队列转发到原有信号，单个任务失败不影响其他任务。
+        取消时置位共享标志，正在渲染的任务在当前帧后中止，排队中的任务不再开始。"""
+        engine = load_video_generator()
+        total_tasks = len(self.tasks)
+        task_progress = [0] * total_tasks
+        failed = 0
+        # 本进程里有 Qt 线程和分词预热线程，fork 出的子进程可能继承被占用的锁而卡死，统一用 spawn
+        context = multiprocessing.get_context("spawn")
+        cancel_event = context.Event()
+        with context.Manager() as manager:
+            events = manager.Queue()
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=engine.init_render_worker,
+                                     initargs=(cancel_event,)) as pool:
+                futures = {pool.submit(engine.run_render_task, i, task, threads, events): i
+                           for i, task in enumerate(self.tasks)}
+                pending = set(futures)
+                while pending:
+                    if self._is_cancelled:
+                        cancel_event.set()
+                        for future in pending: future.cancel()
+                    done, pending = wait(pending, timeout=0.2)
+                    self._forward_events(events, task_progress)
+                    for future in done:
+                        i = futures[future]
+                        task_progress[i] = 100
+                        if future.cancelled(): continue
+                        try:
+                            future.result()
+                        except engine.Cancelled:
+                            continue
+                        except Exception as e:
+                            failed += 1
+                            self.error.emit(f"处理 '{self.tasks[i].get('name', 'video')}' 时出错: {e}")
+                            continue
+                        self._record_success(i)
+            self._forward_events(events, task_progress)
+        self._emit_finished(failed)
+
+    def _forward_events(self, events, task_progress):
+        total_tasks = len(self.tasks)
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            i = event[1]
+            if event[0] == "started":
+                self.task_started.emit(self.tasks[i])
+            else:
+                task_progress[i] = event[2]
+                overall = sum(task_progress) // total_tasks
+                self.progress.emit(overall, f"({i + 1}/{total_tasks}) {self.tasks[i].get('name', 'video')}: {event[3]}")
 
     def cancel(self):
         self._is_cancelled = True
@@ -267,8 +492,11 @@ class MusicVideoApp(QMainWindow):
 
         self.files = {'cover': None, 'lrc': None, 'audio': None}
         self.batch_tasks = []
+        self.output_dir = os.path.join(os.path.expanduser("~"), "Videos", "MusicVideoOutput")
         self.player = QMediaPlayer()
         self.worker_thread = None
+        self.waveform_threads = []
+        self.waveform_audio = None
         self.init_ui()
         self.connect_signals()
         self.switch_mode(0)
@@ -302,9 +530,26 @@ class MusicVideoApp(QMainWindow):
         self.stacked_widget.addWidget(self.create_batch_mode_panel())
         left_layout.addWidget(self.stacked_widget, 1)
 
+        profiles_box = QFrame();
+        profiles_box.setObjectName("ControlGroupBox")
+        profiles_layout = QVBoxLayout(profiles_box)
+        profiles_layout.addWidget(QLabel("输出规格"))
+        self.profile_checks = {}
+        for name, label in OUTPUT_PROFILE_CHOICES:
+            check = QCheckBox(label);
+            check.setChecked(name == "720p")
+            check.toggled.connect(self.check_start_button_state)
+            self.profile_checks[name] = check
+            profiles_layout.addWidget(check)
+        left_layout.addWidget(profiles_box)
+
         self.start_btn = QPushButton("开始生成");
         self.start_btn.setFixedHeight(45)
         left_layout.addWidget(self.start_btn)
+        self.cancel_btn = QPushButton("取消生成");
+        self.cancel_btn.setFixedHeight(45)
+        self.cancel_btn.setVisible(False)
+        left_layout.addWidget(self.cancel_btn)
         main_layout.addWidget(self.left_panel)
 
         content_widget = QWidget()
@@ -367,6 +612,25 @@ class MusicVideoApp(QMainWindow):
             box_layout.addWidget(button)
             layout.addWidget(box)
 
+        preview_box = QFrame();
+        preview_box.setObjectName("ControlGroupBox")
+        preview_layout = QVBoxLayout(preview_box)
+        range_layout = QHBoxLayout()
+        self.preview_start_edit = QLineEdit("00:00");
+        self.preview_end_edit = QLineEdit("00:20")
+        range_layout.addWidget(QLabel("预览区间"));
+        range_layout.addWidget(self.preview_start_edit);
+        range_layout.addWidget(QLabel("-"));
+        range_layout.addWidget(self.preview_end_edit)
+        self.preview_scale_combo = QComboBox()
+        self.preview_scale_combo.addItem("1/2 分辨率", 0.5);
+        self.preview_scale_combo.addItem("1/4 分辨率", 0.25)
+        self.preview_btn = QPushButton("快速预览")
+        preview_layout.addLayout(range_layout);
+        preview_layout.addWidget(self.preview_scale_combo);
+        preview_layout.addWidget(self.preview_btn)
+        layout.addWidget(preview_box)
+
         layout.addStretch()
         return widget
 
@@ -377,14 +641,26 @@ class MusicVideoApp(QMainWindow):
         layout.setSpacing(10)
         self.batch_folder_btn = QPushButton("选择文件夹...");
         self.task_list_widget = QListWidget()
+        budget_layout = QHBoxLayout()
+        self.core_budget_spin = QSpinBox();
+        self.core_budget_spin.setRange(1, os.cpu_count() or 1);
+        self.core_budget_spin.setValue(os.cpu_count() or 1)
+        budget_layout.addWidget(QLabel("CPU 核心预算"));
+        budget_layout.addWidget(self.core_budget_spin)
+        self.skip_unchanged_check = QCheckBox("跳过未变化的任务")
+        self.skip_unchanged_check.setChecked(True)
         layout.addWidget(self.batch_folder_btn);
         layout.addWidget(self.task_list_widget, 1)
+        layout.addLayout(budget_layout)
+        layout.addWidget(self.skip_unchanged_check)
         return widget
 
     def connect_signals(self):
         self.single_mode_btn.clicked.connect(lambda: self.switch_mode(0));
         self.batch_mode_btn.clicked.connect(lambda: self.switch_mode(1))
         self.start_btn.clicked.connect(self.start_generation)
+        self.cancel_btn.clicked.connect(self.cancel_generation)
+        self.preview_btn.clicked.connect(self.start_preview)
         self.batch_folder_btn.clicked.connect(self.select_batch_folder)
         self.cover_preview.file_selected.connect(lambda path: self.set_file('cover', path))
         self.play_btn.clicked.connect(self.toggle_playback)
@@ -437,18 +713,23 @@ class MusicVideoApp(QMainWindow):
             self.player.setMedia(QMediaContent());
             self.play_btn.setEnabled(False);
             self.time_slider.setEnabled(False)
+            self.waveform_audio = None
             self.waveform_widget.set_waveform(None);
             self.update_time_label(0, 0)
 
     def extract_waveform(self, audio_path):
-        try:
-            from moviepy.editor import AudioFileClip
-            with AudioFileClip(audio_path) as clip:
-                arr = clip.to_soundarray(fps=4000)
-            if arr.ndim > 1: arr = arr.mean(axis=1)
-            self.waveform_widget.set_waveform(arr)
-        except Exception as e:
-            print(f"提取波形失败: {e}"); self.waveform_widget.set_waveform(None)
+        """在后台线程中解码波形，界面不等待；之前尚未完成的解码直接取消。"""
+        for thread in self.waveform_threads: thread.cancel()
+        self.waveform_audio = audio_path
+        self.waveform_widget.set_waveform(None)
+        thread = WaveformThread(audio_path)
+        thread.ready.connect(self.on_waveform_ready)
+        thread.finished.connect(lambda: self.waveform_threads.remove(thread))
+        self.waveform_threads.append(thread)
+        thread.start()
+
+    def on_waveform_ready(self, audio_path, pyramid):
+        if audio_path == self.waveform_audio: self.waveform_widget.set_waveform(pyramid)
 
     def select_file(self, file_type):
         if not self.is_single_mode(): return
@@ -459,6 +740,7 @@ class MusicVideoApp(QMainWindow):
     def select_batch_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "选择文件夹")
         if folder:
+            self.batch_folder = folder
             self.batch_tasks = self._collect_tasks(folder)
             self.task_list_widget.clear()
             if not self.batch_tasks:
@@ -471,28 +753,75 @@ class MusicVideoApp(QMainWindow):
     def check_start_button_state(self):
         is_single = self.is_single_mode()
         ready = (all(self.files.values()) if is_single else bool(self.batch_tasks))
-        self.start_btn.setEnabled(ready)
+        self.start_btn.setEnabled(ready and bool(self.selected_profiles()))
+        self.preview_btn.setEnabled(is_single and ready)
+
+    def selected_profiles(self):
+        return [name for name, check in self.profile_checks.items() if check.isChecked()]
 
     def start_generation(self):
         if self.player.state() == QMediaPlayer.PlayingState: self.player.pause()
 
-        output_dir = QFileDialog.getExistingDirectory(self, "选择输出文件夹",
-                                                      os.path.join(os.path.expanduser("~"), "Videos",
-                                                                   "MusicVideoOutput"))
+        output_dir = QFileDialog.getExistingDirectory(self, "选择输出文件夹", self.output_dir)
         if not output_dir: return
+        self.output_dir = output_dir
 
         tasks = self._collect_tasks(self.files if self.is_single_mode() else self.batch_folder, output_dir)
         if not tasks: self.show_error("没有可执行的任务。"); return
+        profiles = self.selected_profiles()
+        if profiles != ["720p"]:
+            for task in tasks: task['render_options'] = {'profiles': profiles}
+        # 只有批量模式按渲染记录跳过未变化的任务；单曲渲染总是重新生成
+        incremental = not self.is_single_mode() and self.skip_unchanged_check.isChecked()
+        self._run_tasks(tasks, self.on_generation_finished, incremental)
+
+    def start_preview(self):
+        """以低分辨率快速渲染选定区间，完成后用系统播放器打开，用于确认版式。"""
+        if self.player.state() == QMediaPlayer.PlayingState: self.player.pause()
+        try:
+            start = parse_time_text(self.preview_start_edit.text())
+            end = parse_time_text(self.preview_end_edit.text())
+        except ValueError:
+            self.show_error("预览区间格式应为 分:秒，例如 01:30。"); return
+        if end <= start: self.show_error("预览结束时间必须晚于开始时间。"); return
 
+        tasks = self._collect_tasks(self.files, tempfile.gettempdir())
+        if not tasks: self.show_error("没有可执行的任务。"); return
+        task = tasks[0]
+        task['output_path'] = os.path.join(tempfile.gettempdir(), f"{task['name']}_preview.mp4")
+        # 删掉上一次的预览，渲染失败时才不会把旧文件当作新预览打开
+        if os.path.exists(task['output_path']):
+            try:
+                os.remove(task['output_path'])
+            except OSError:
+                pass
+        # 预览输出在临时目录，计划仍按正式输出的位置读取，与完整渲染共用
+        plan_path = load_video_generator().render_plan_path(os.path.join(self.output_dir, f"{task['name']}.mp4"))
+        task['render_options'] = {'time_range': (start, end), 'preview': self.preview_scale_combo.currentData(),
+                                  'plan_path': plan_path}
+        self._run_tasks([task], lambda message: self.on_preview_finished(task['output_path']), incremental=False)
+
+    def _run_tasks(self, tasks, on_finished, incremental=True):
         self.start_btn.setEnabled(False);
+        self.preview_btn.setEnabled(False);
         self.progress_bar.setVisible(True)
-        self.worker_thread = VideoGenerationThread(tasks)
+        self.worker_thread = VideoGenerationThread(tasks, self.core_budget_spin.value(), incremental)
         self.worker_thread.task_started.connect(self.update_preview_for_task)
         self.worker_thread.progress.connect(self.update_progress)
-        self.worker_thread.finished_signal.connect(self.on_generation_finished)
+        self.worker_thread.finished_signal.connect(on_finished)
+        self.worker_thread.cancelled_signal.connect(self.on_generation_cancelled)
         self.worker_thread.error.connect(self.show_error)
+        self.worker_thread.finished.connect(lambda: self.cancel_btn.setVisible(False))
+        self.cancel_btn.setEnabled(True)
+        self.cancel_btn.setVisible(True)
         self.worker_thread.start()
 
+    def cancel_generation(self):
+        if self.worker_thread and self.worker_thread.isRunning():
+            self.worker_thread.cancel()
+            self.cancel_btn.setEnabled(False)
+            self.status_label.setText("正在取消...")
+
     def _collect_tasks(self, source, output_dir=None):
         if isinstance(source, dict):
             if not all(source.values()): return []
@@ -544,6 +873,17 @@ class MusicVideoApp(QMainWindow):
         self.status_label.setText(message); self.check_start_button_state(); self.progress_bar.setValue(
             100); QMessageBox.information(self, "完成", message)
 
+    def on_generation_cancelled(self, message):
+        self.status_label.setText(message); self.check_start_button_state()
+        self.progress_bar.setVisible(False)
+
+    def on_preview_finished(self, output_path):
+        self.check_start_button_state(); self.progress_bar.setVisible(False)
+        if not os.path.exists(output_path):
+            self.status_label.setText("预览生成失败。"); return
+        self.status_label.setText(f"预览已生成: {output_path}")
+        QDesktopServices.openUrl(QUrl.fromLocalFile(output_path))
+
     def show_error(self, message):
         QMessageBox.warning(self, "出错啦", message); self.status_label.setText(
             f"错误: {message}"); self.check_start_button_state(); self.progress_bar.setVisible(False)
@@ -560,6 +900,8 @@ class MusicVideoApp(QMainWindow):
     def update_slider_position(self, position):
         self.time_slider.blockSignals(True); self.time_slider.setValue(position); self.time_slider.blockSignals(
             False); self.update_time_label(position, self.player.duration())
+        duration = self.player.duration()
+        self.waveform_widget.set_playhead(position / duration if duration > 0 else None)
 
     def update_duration(self, duration):
         self.time_slider.setRange(0, duration); self.update_time_label(self.player.position(), duration)
@@ -573,9 +915,20 @@ class MusicVideoApp(QMainWindow):
 
     def closeEvent(self, event):
         if self.worker_thread and self.worker_thread.isRunning(): self.worker_thread.cancel(); self.worker_thread.wait()
+        for thread in list(self.waveform_threads): thread.cancel(); thread.wait()
         event.accept()
 
 
+def parse_time_text(text):
+    """把 "分:秒" 或纯秒数的文本转换成秒。"""
+    parts = text.strip().split(':')
+    if not 1 <= len(parts) <= 2: raise ValueError(text)
+    seconds = float(parts[-1])
+    if len(parts) == 2: seconds += int(parts[0]) * 60
+    if seconds < 0: raise ValueError(text)
+    return seconds
+
+
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS
@@ -585,8 +938,15 @@ def resource_path(relative_path):
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    multiprocessing.freeze_support()  # 打包后分段渲染的子进程需要
+    timer = StartupTimer("--startup-timing" in sys.argv)
+    timer.mark("模块导入完成")
+    app = QApplication([arg for arg in sys.argv if arg != "--startup-timing"])
+    timer.mark("QApplication 创建完成")
     window = MusicVideoApp()
+    timer.mark("主窗口构建完成")
     window.show()
+    QTimer.singleShot(0, lambda: timer.mark("窗口已显示"))
+    QTimer.singleShot(0, lambda: warm_up_engine(lambda: timer.mark("渲染引擎与分词词典就绪")))
     sys.exit(app.exec_())
 
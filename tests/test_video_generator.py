@@ -0,0 +1,311 @@
+import hashlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pytest
+
+import video_generator as vg
+
+
+def float_over(dst, src):
+    alpha = src[..., 3:].astype(np.float64)
+    return np.round((src[..., :3] * alpha + dst * (255 - alpha)) / 255).astype(np.uint8)
+
+
+def test_blend_over_matches_float_for_every_alpha_and_value():
+    # 行为 alpha、列为源通道值，穷举全部组合；底色取几个典型值
+    alpha, value = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    src = np.stack([value, value, value, alpha], axis=-1).astype(np.uint8)
+    pool = vg.FrameBufferPool((256, 256))
+    for base in (0, 1, 77, 128, 254, 255):
+        dst = np.full((256, 256, 3), base, dtype=np.uint8)
+        expected = float_over(dst, src)
+        vg.blend_over(dst, src, pool)
+        np.testing.assert_array_equal(dst, expected)
+
+
+def test_blend_over_random_region_of_larger_pool():
+    rng = np.random.default_rng(0)
+    dst = rng.integers(0, 256, (37, 53, 3), dtype=np.uint8)
+    src = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    expected = float_over(dst, src)
+    vg.blend_over(dst, src, vg.FrameBufferPool((128, 72)))
+    np.testing.assert_array_equal(dst, expected)
+
+
+def make_timeline():
+    # 第 1、2 句之间有 [3, 5) 的间隙
+    return vg.LyricTimeline([
+        {"start": 2.0, "end": 3.0, "text": "b"},
+        {"start": 0.0, "end": 2.0, "text": "a"},
+        {"start": 5.0, "end": 6.0, "text": "c"},
+    ])
+
+
+def test_indices_at_boundaries():
+    timeline = make_timeline()
+    times = [-0.1, 0.0, 1.999, 2.0, 2.999, 3.0, 4.999, 5.0, 6.0, 100.0]
+    expected = [-1, 0, 0, 1, 1, -1, -1, 2, -1, -1]
+    np.testing.assert_array_equal(timeline.indices_at(times), expected)
+    assert [timeline.index_at(t) for t in times] == expected
+
+
+def test_indices_at_empty_timeline():
+    np.testing.assert_array_equal(vg.LyricTimeline().indices_at([0.0, 1.0]), [-1, -1])
+
+
+def test_scroll_curve_matches_per_frame_easing():
+    timeline = vg.LyricTimeline([
+        {"start": 0.0, "end": 1.0, "text": "a"},
+        {"start": 1.5, "end": 3.0, "text": "b"},
+        {"start": 3.0, "end": 4.0, "text": "c"},
+    ])
+    targets = [40.0, 160.0, 220.0]
+    scroll_at = vg.build_scroll_curve(timeline, targets)
+    # 参照逐帧缓动：有当前句的帧向其目标靠近 SCROLL_EASING，间隙中保持不动
+    scroll, expected = 0.0, {}
+    for n in range(5 * vg.FPS):
+        idx = timeline.index_at(n / vg.FPS)
+        if idx < 0: continue
+        scroll += (targets[idx] - scroll) * vg.SCROLL_EASING
+        expected[n] = (idx, scroll)
+    # 倒序查询，确认任意帧都可独立计算
+    for n in sorted(expected, reverse=True):
+        idx, value = expected[n]
+        assert abs(scroll_at(idx, n / vg.FPS) - value) < 1e-9
+
+
+class FixedWidthFont:
+    """每个字符宽 10 像素的替身字体，擦除位置与字体文件无关。"""
+
+    def getlength(self, text):
+        return 10.0 * len(text)
+
+
+def test_split_word_times():
+    assert vg.split_word_times("<00:01.00>Hello <00:01.50>world") == ("Hello world", [(1.0, 0), (1.5, 6)])
+    assert vg.split_word_times("  <01:02.5> hi ") == ("hi", [(62.5, 0)])
+    assert vg.split_word_times("plain line") == ("plain line", [])
+
+
+def test_split_word_times_trailing_tag_only():
+    assert vg.split_word_times("trail only<00:09.00>") == ("trail only", [(9.0, 10)])
+
+
+def test_karaoke_wipe_keys_across_lines():
+    text, words = vg.split_word_times("<00:01.00>Hello <00:01.50>world")
+    lyric = {"start": 1.0, "end": 3.0, "text": text, "words": words}
+    times, positions, lefts = vg.karaoke_wipe_keys(lyric, ["Hello", "world"], FixedWidthFont())
+    assert lefts == [0, 50]
+    np.testing.assert_array_equal(times, [1.0, 1.5, 3.0])
+    np.testing.assert_array_equal(positions, [0, 50, 100])
+
+
+def test_karaoke_wipe_keys_trailing_tag_starts_at_zero():
+    text, words = vg.split_word_times("trail only<00:09.00>")
+    lyric = {"start": 5.0, "end": 10.0, "text": text, "words": words}
+    times, positions, _ = vg.karaoke_wipe_keys(lyric, [text], FixedWidthFont())
+    np.testing.assert_array_equal(times, [5.0, 9.0])
+    np.testing.assert_array_equal(positions, [0, 100])
+    assert np.interp(5.0, times, positions) == 0
+
+
+def test_karaoke_wipe_keys_times_never_go_back():
+    lyric = {"start": 0.0, "end": 4.0, "text": "ab cd", "words": [(2.0, 0), (1.0, 3)]}
+    times, _, _ = vg.karaoke_wipe_keys(lyric, ["ab cd"], FixedWidthFont())
+    assert np.all(np.diff(times) >= 0)
+
+
+def test_shared_frame_ring_runs_stop_at_ring_end():
+    ring = vg.SharedFrameRing((2, 2, 3), 4)
+    try:
+        ring.write_run(0, 2, lambda view: None)  # 已写出 0、1 两帧，槽位 0、1 空出
+        for n in (2, 3, 4, 5):
+            ring.acquire(n)[:] = n
+            ring.publish(n)
+        # 第 2、3 帧在环尾，第 4、5 帧回到槽位 0、1：一段连续内存最多到环尾
+        assert ring.wait_run(2, 100) == 2
+        ring.write_run(2, 2, lambda view: None)
+        assert ring.wait_run(4, 100) == 2
+        assert ring.wait_run(4, 5) == 1
+    finally:
+        ring.close()
+
+
+def produce_ring_frames(ring, worker, workers, total):
+    for n in range(worker, total, workers):
+        ring.acquire(n)[:] = n
+        ring.publish(n)
+
+
+def test_shared_frame_ring_keeps_frame_order_across_processes():
+    context = multiprocessing.get_context("spawn")
+    slots, total, workers = 4, 23, 2
+    ring = vg.SharedFrameRing((2, 3, 3), slots, context)
+    producers = [context.Process(target=produce_ring_frames, args=(ring, i, workers, total)) for i in range(workers)]
+    deadline = time.monotonic() + 60
+
+    def check():
+        if time.monotonic() > deadline: raise TimeoutError("帧环没有按时交付")
+
+    written = []
+    try:
+        for p in producers: p.start()
+        n = 0
+        while n < total:
+            count = ring.wait_run(n, total, check)
+            assert n % slots + count <= slots
+            ring.write_run(n, count, lambda view: written.append(bytes(view)))
+            n += count
+        for p in producers: p.join(10)
+        assert all(p.exitcode == 0 for p in producers)
+        stats = ring.stats()
+    finally:
+        for p in producers:
+            if p.is_alive(): p.kill()
+        ring.close()
+    frames = np.frombuffer(b"".join(written), dtype=np.uint8).reshape(total, -1)
+    np.testing.assert_array_equal(frames[:, 0], np.arange(total))
+    assert (frames == frames[:, :1]).all()
+    assert stats["frames"] == total and stats["slot_reuses"] == total - slots
+
+
+def test_ffmpeg_pipe_encoder_closes_pipes(tmp_path):
+    frame = np.zeros((16, 16, 3), dtype=np.uint8)
+    encoder = vg.FFmpegPipeEncoder(str(tmp_path / "ok.mp4"), (16, 16), batch_frames=2)
+    for _ in range(3): encoder.write_frame(frame)
+    encoder.close()
+    assert encoder._proc.stdin.closed and encoder._proc.stderr.closed
+    assert (tmp_path / "ok.mp4").stat().st_size > 0
+
+    encoder = vg.FFmpegPipeEncoder(str(tmp_path / "aborted.mp4"), (16, 16), batch_frames=2)
+    encoder.write_frame(frame)
+    encoder.abort()
+    assert encoder._proc.stdin.closed and encoder._proc.stderr.closed
+
+
+def make_task(tmp_path, **render_options):
+    (tmp_path / "Fonts").mkdir(exist_ok=True)
+    for style in ("Bold", "Regular"):
+        (tmp_path / "Fonts" / f"NotoSans-{style}.ttf").write_bytes(style.encode())
+    files = {"audio_path": b"audio", "lyrics_path": b"[00:01.00]hello\n", "cover_path": b"cover"}
+    task = {"name": "song", "output_path": str(tmp_path / "song.mp4")}
+    for key, data in files.items():
+        path = tmp_path / key
+        if not path.exists(): path.write_bytes(data)
+        task[key] = str(path)
+    if render_options: task["render_options"] = render_options
+    return task
+
+
+def render_and_record(tmp_path, task):
+    """模拟一次成功的渲染：写出输出文件并记进渲染记录，返回记录。"""
+    key, inputs = vg.compute_render_key(task, fonts_dir=str(tmp_path / "Fonts"))
+    for path in vg.task_output_paths(task):
+        with open(path, "wb") as f: f.write(b"video")
+    history_path = str(tmp_path / "history.json")
+    vg.record_render(task, key, inputs, history_path)
+    return vg.load_render_history(history_path)
+
+
+def is_current(tmp_path, task, history):
+    key, _ = vg.compute_render_key(task, history, fonts_dir=str(tmp_path / "Fonts"))
+    return vg.find_current_render(task, key, history) is not None
+
+
+def test_unchanged_task_is_skipped(tmp_path):
+    task = make_task(tmp_path)
+    history = render_and_record(tmp_path, task)
+    assert is_current(tmp_path, task, history)
+
+
+def test_changed_inputs_invalidate_render(tmp_path, monkeypatch):
+    task = make_task(tmp_path)
+    history = render_and_record(tmp_path, task)
+    lyrics, cover = task["lyrics_path"], task["cover_path"]
+
+    with open(lyrics, "ab") as f: f.write(b"[00:02.00]again\n")
+    assert not is_current(tmp_path, task, history)
+    history = render_and_record(tmp_path, task)
+
+    with open(cover, "wb") as f: f.write(b"other cover")
+    assert not is_current(tmp_path, task, history)
+    history = render_and_record(tmp_path, task)
+
+    assert not is_current(tmp_path, make_task(tmp_path, preview=0.5), history)
+    assert not is_current(tmp_path, make_task(tmp_path, profiles=["720p", "vertical"]), history)
+    monkeypatch.setattr(vg, "RENDER_VERSION", vg.RENDER_VERSION + 1)
+    assert not is_current(tmp_path, task, history)
+
+
+def test_output_with_different_size_is_rendered_again(tmp_path):
+    task = make_task(tmp_path)
+    history = render_and_record(tmp_path, task)
+    with open(task["output_path"], "ab") as f: f.write(b"truncated or replaced")
+    assert not is_current(tmp_path, task, history)
+    os.remove(task["output_path"])
+    assert not is_current(tmp_path, task, history)
+
+
+def test_stored_hash_reused_only_when_size_and_mtime_match(tmp_path):
+    task = make_task(tmp_path)
+    lyrics = task["lyrics_path"]
+    st = os.stat(lyrics)
+    record = {"path": lyrics, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": "stored"}
+    history = [{"file_path": "other.mp4", "inputs": {"lyrics": record}}]
+    _, inputs = vg.compute_render_key(task, history, fonts_dir=str(tmp_path / "Fonts"))
+    assert inputs["lyrics"]["sha256"] == "stored"
+
+    os.utime(lyrics, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    _, inputs = vg.compute_render_key(task, history, fonts_dir=str(tmp_path / "Fonts"))
+    assert inputs["lyrics"]["sha256"] == hashlib.sha256(b"[00:01.00]hello\n").hexdigest()
+
+
+def make_plan_inputs(tmp_path):
+    lyrics, cover = tmp_path / "song.lrc", tmp_path / "cover.jpg"
+    lyrics.write_text("[00:00.00]first line\n[00:01.00]second line\n", encoding="utf-8")
+    cover.write_bytes(b"cover")
+    return str(lyrics), str(cover)
+
+
+SMALL_LAYOUTS = [vg.render_layout(0.25, (1280, 720)), vg.render_layout(0.25, (720, 1280))]
+
+
+def test_load_render_plan_rejects_stale_plans(tmp_path, monkeypatch):
+    lyrics, cover = make_plan_inputs(tmp_path)
+    plan_path = str(tmp_path / "song.plan.json")
+    vg.save_render_plan(vg.compile_render_plan(lyrics, cover, 2.0, SMALL_LAYOUTS[:1]), plan_path)
+    assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is not None
+    assert vg.load_render_plan(plan_path, lyrics, cover, 2.5) is None
+
+    fake_font = tmp_path / "other.ttf"
+    fake_font.write_bytes(b"another font")
+    real_font_paths = vg.font_paths
+    with monkeypatch.context() as m:
+        m.setattr(vg, "font_paths", lambda lang, fonts_dir: dict(real_font_paths(lang, fonts_dir), bold=str(fake_font)))
+        assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is None
+    with monkeypatch.context() as m:
+        m.setattr(vg, "RENDER_VERSION", vg.RENDER_VERSION + 1)
+        assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is None
+    with monkeypatch.context() as m:
+        m.setattr(vg, "PLAN_VERSION", vg.PLAN_VERSION + 1)
+        assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is None
+
+    with open(cover, "ab") as f: f.write(b"!")
+    assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is None
+    vg.save_render_plan(vg.compile_render_plan(lyrics, cover, 2.0, SMALL_LAYOUTS[:1]), plan_path)
+    with open(lyrics, "a", encoding="utf-8") as f: f.write("[00:01.50]third line\n")
+    assert vg.load_render_plan(plan_path, lyrics, cover, 2.0) is None
+
+
+def test_compile_render_plan_only_adds_missing_layouts(tmp_path, monkeypatch):
+    lyrics, cover = make_plan_inputs(tmp_path)
+    base = vg.compile_render_plan(lyrics, cover, 2.0, SMALL_LAYOUTS[:1])
+    monkeypatch.setattr(vg, "parse_lyrics", lambda *args: pytest.fail("沿用 base 时不应重新解析歌词"))
+    plan = vg.compile_render_plan(lyrics, cover, 2.0, SMALL_LAYOUTS, base=base)
+    assert len(plan["layouts"]) == 2
+    assert plan["layouts"][0] is base["layouts"][0]
+    assert plan["lyrics"] == base["lyrics"] and plan["brightness"] is base["brightness"]
+    assert vg.compile_render_plan(lyrics, cover, 2.0, SMALL_LAYOUTS[::-1], base=plan) is plan
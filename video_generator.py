@@ -1,15 +1,89 @@
 import os
 import sys
 import re
+import json
+import bisect
+import hashlib
+import shutil
+import time
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait
 import numpy as np
 from PIL import Image, ImageDraw, ImageFilter, ImageFont
 from PIL.Image import Resampling
 import pylrc
-import moviepy.editor as mpy
-import jieba
+# moviepy 与 jieba 导入较慢，只在首次用到时才在函数内导入，让 GUI 和命令行尽快启动
+
+FPS = 24
+SCROLL_EASING = 0.08  # 每帧滚动向目标位置靠近的比例
+SCROLL_SETTLE_PX = 0.05  # 与目标位置的距离小于此值即视为滚动已停止
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lyric_video")
+CACHE_MAX_BYTES = 2 << 30
 
 
 # --- 1. 工具函数 ---
+def ffmpeg_binary():
+    """ffmpeg 可执行文件路径，沿用 moviepy 的配置（FFMPEG_BINARY 环境变量或 imageio-ffmpeg 自带的版本）。"""
+    from moviepy.config import get_setting
+    return get_setting("FFMPEG_BINARY")
+
+
+def _load_jieba():
+    import jieba
+    if jieba.dt.tmp_dir is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        jieba.dt.tmp_dir = CACHE_DIR  # 词典缓存放在持久目录，不随系统临时目录清理
+    return jieba
+
+
+def warm_up_segmenter(background=True):
+    """预先加载 jieba 词典，避免在首次渲染中文歌词时才构建。background 为 True 时在守护线程中进行。"""
+    def load():
+        _load_jieba().initialize()
+
+    if not background:
+        load()
+        return None
+    thread = threading.Thread(target=load, name="jieba-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def probe_audio(audio_path):
+    """用一次 ffmpeg -i 读出音频的时长（秒）和编码名称，不解码音频。"""
+    result = subprocess.run([ffmpeg_binary(), "-hide_banner", "-i", audio_path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    info = result.stderr.decode("utf-8", "replace")
+    duration = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", info)
+    if not duration:
+        raise IOError(f"无法读取音频时长: {audio_path}")
+    hours, minutes, seconds = duration.groups()
+    codec = re.search(r"Stream #\d+:\d+.*?: Audio: (\w+)", info)
+    return {"duration": int(hours) * 3600 + int(minutes) * 60 + float(seconds),
+            "codec": codec.group(1) if codec else None}
+
+
+@contextmanager
+def scratch_directory(prefix="lyric_job_"):
+    """每个渲染任务独立的临时目录，结束时（包括失败与取消）整个删除；并发任务互不干扰，也不会在输出目录留下文件。"""
+    path = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class Cancelled(Exception):
+    """调用方通过 cancelled 回调请求中止时抛出。"""
+
+
 def resource_path(relative_path):
     """获取资源的绝对路径，兼容PyInstaller。"""
     try:
@@ -27,77 +101,261 @@ def detect_language(text):
     return 'en'
 
 
+FONT_MAP = {'zh': "NotoSansSC", 'ja': "NotoSansJP", 'en': "NotoSans"}
+
+
+def font_paths(lang, fonts_dir):
+    """返回该语言使用的粗体与常规字体文件路径。"""
+    font_name = FONT_MAP.get(lang, "NotoSans")
+    return {
+        "bold": resource_path(os.path.join(fonts_dir, f"{font_name}-Bold.ttf")),
+        "regular": resource_path(os.path.join(fonts_dir, f"{font_name}-Regular.ttf"))
+    }
+
+
 def load_fonts(lang, fonts_dir, size_lyric, size_small):
     """根据检测到的语言加载对应的字体文件。"""
-    font_map = {'zh': "NotoSansSC", 'ja': "NotoSansJP", 'en': "NotoSans"}
-    font_name = font_map.get(lang, "NotoSans")
+    font_name = FONT_MAP.get(lang, "NotoSans")
+    paths = font_paths(lang, fonts_dir)
     try:
         print(f"检测到语言: {lang}, 加载字体: {font_name}")
         fonts = {
-            "bold": ImageFont.truetype(resource_path(os.path.join(fonts_dir, f"{font_name}-Bold.ttf")), size_lyric),
-            "regular": ImageFont.truetype(resource_path(os.path.join(fonts_dir, f"{font_name}-Regular.ttf")),
-                                          size_small)
+            "bold": ImageFont.truetype(paths["bold"], size_lyric),
+            "regular": ImageFont.truetype(paths["regular"], size_small)
         }
         return fonts
     except IOError:
         raise IOError(f"字体文件加载失败: {font_name}。请确保Fonts文件夹和字体文件存在。")
 
 
-def wrap_text(text, font, max_width, lang):
-    """根据语言智能换行。"""
-    lines = []
-    if lang == 'en':
-        words = text.split(' ')
-        line = ''
-        for word in words:
-            if font.getbbox(line + ' ' + word)[2] <= max_width:
-                line += ' ' + word if line else word
-            else:
-                if line: lines.append(line)
-                line = word
-        if line: lines.append(line)
-    elif lang == 'zh':
-        words = jieba.lcut(text)
-        line = ''
-        for word in words:
-            if font.getbbox(line + word)[2] <= max_width:
-                line += word
-            else:
-                if line: lines.append(line)
-                line = word
-        if line: lines.append(line)
-    else:
-        line = ''
-        for char in text:
-            if font.getbbox(line + char)[2] <= max_width:
-                line += char
+class SegmentationCache:
+    """jieba 分词结果的持久化缓存，以 JSON 保存在 path（默认在 CACHE_DIR 中）。"""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, "jieba_segments.json")
+        self._segments = None
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._segments = json.load(f)
+        except (OSError, ValueError):
+            self._segments = {}
+
+    def cut(self, text):
+        if self._segments is None: self._load()
+        words = self._segments.get(text)
+        if words is None:
+            words = self._segments[text] = _load_jieba().lcut(text)
+            self._dirty = True
+        return words
+
+    def save(self):
+        if not self._dirty: return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._segments, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            print(f"写入分词缓存失败: {e}")
+
+
+_segmentation_cache = SegmentationCache()
+
+
+class TextLayoutEngine:
+    """按字体缓存词元宽度与底边、逐词累加判断换行的换行引擎。"""
+
+    def __init__(self, font, lang, segmenter=None):
+        self.font = font
+        self.lang = lang
+        self.segmenter = segmenter or _segmentation_cache
+        self._metrics = {}
+
+    def token_metrics(self, token):
+        """返回词元的 (前进宽度, 墨迹右边界, 底边)。"""
+        metrics = self._metrics.get(token)
+        if metrics is None:
+            _, _, right, bottom = self.font.getbbox(token) if token else (0, 0, 0, 0)
+            metrics = self._metrics[token] = (self.font.getlength(token), right, bottom)
+        return metrics
+
+    def tokenize(self, text):
+        if self.lang == 'en': return text.split(' '), ' '
+        if self.lang == 'zh': return self.segmenter.cut(text), ''
+        return list(text), ''
+
+    def layout(self, text, max_width):
+        """换行并同时返回每行高度：{"lines": [...], "heights": [...]}。"""
+        tokens, sep = self.tokenize(text)
+        sep_advance = self.token_metrics(sep)[0] if sep else 0.0
+        lines, heights = [], []
+        line, advance, bottom = [], 0.0, 0
+        for token in tokens:
+            token_advance, token_right, token_bottom = self.token_metrics(token)
+            if advance + sep_advance + token_right <= max_width:
+                advance += (sep_advance if line else 0.0) + token_advance
+                line.append(token)
+                bottom = max(bottom, token_bottom)
             else:
-                if line: lines.append(line)
-                line = char
-        if line: lines.append(line)
-    return lines if lines else [""]
+                if line:
+                    lines.append(sep.join(line))
+                    heights.append(bottom)
+                line, advance, bottom = [token], token_advance, token_bottom
+        if line:
+            lines.append(sep.join(line))
+            heights.append(bottom)
+        if not lines: return {"lines": [""], "heights": [0]}
+        return {"lines": lines, "heights": heights}
+
+
+_layout_engines = {}
+
+
+def get_layout_engine(font, lang, segmenter=None):
+    key = (font.path, font.size, lang, segmenter)
+    engine = _layout_engines.get(key)
+    if engine is None:
+        engine = _layout_engines[key] = TextLayoutEngine(font, lang, segmenter)
+    return engine
+
+
+def wrap_text(text, font, max_width, lang, segmenter=None):
+    """根据语言智能换行。"""
+    return get_layout_engine(font, lang, segmenter).layout(text, max_width)["lines"]
+
+
+class LyricTimeline(list):
+    """按开始时间排序的歌词列表，附带 NumPy 起止时间数组，支持 O(log n) 查找当前歌词。"""
+
+    def __init__(self, lyrics=()):
+        super().__init__(sorted(lyrics, key=lambda l: l["start"]))
+        self.starts = np.array([l["start"] for l in self], dtype=np.float64)
+        self.ends = np.array([l["end"] for l in self], dtype=np.float64)
+
+    def index_at(self, t):
+        """返回时间 t 正在播放的歌词下标，处于间隙时返回 -1。"""
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i if i >= 0 and t < self.ends[i] else -1
+
+    def indices_at(self, times):
+        """批量查询：对一组时间戳一次性返回下标数组，间隙为 -1。"""
+        times = np.asarray(times, dtype=np.float64)
+        idx = np.searchsorted(self.starts, times, side="right") - 1
+        valid = idx >= 0
+        valid[valid] = times[valid] < self.ends[idx[valid]]
+        return np.where(valid, idx, -1)
+
+
+WORD_TIME_TAG = re.compile(r"<(\d+):(\d+(?:\.\d+)?)>")
+
+
+def split_word_times(text):
+    """拆出增强 LRC 的逐字时间标签 <mm:ss.xx>，返回 (去掉标签并去除首尾空白的文本, [(时间, 字符偏移), ...])。
+    偏移指向标签之后的第一个字符；行尾的标签（偏移等于文本长度）表示整句在该时刻唱完。"""
+    parts, words, length = [], [], 0
+    pos = 0
+    for match in WORD_TIME_TAG.finditer(text):
+        parts.append(text[pos:match.start()])
+        length += match.start() - pos
+        words.append((int(match.group(1)) * 60 + float(match.group(2)), length))
+        pos = match.end()
+    parts.append(text[pos:])
+    raw = "".join(parts)
+    clean = raw.strip()
+    lead = len(raw) - len(raw.lstrip())
+    return clean, [(time, min(max(offset - lead, 0), len(clean))) for time, offset in words]
 
 
 def parse_lyrics(lyrics_path, audio_duration):
-    """解析LRC文件。"""
+    """解析LRC文件，返回 LyricTimeline。带逐字时间（增强 LRC）的句子另有 "words": [(时间, 字符偏移), ...]。"""
     try:
         with open(lyrics_path, "r", encoding="utf-8") as f:
             lrc_string = f.read()
     except Exception:
         return None
-    subs = pylrc.parse(lrc_string)
-    if not subs: return []
+    subs = sorted(pylrc.parse(lrc_string), key=lambda sub: sub.time)
+    if not subs: return LyricTimeline()
     processed_lyrics = []
     for i, sub in enumerate(subs):
-        text = sub.text.strip()
+        text, words = split_word_times(sub.text)
         if not text: continue
         end_time = subs[i + 1].time if i + 1 < len(subs) else audio_duration
-        processed_lyrics.append({"start": sub.time, "end": end_time, "text": text})
-    return processed_lyrics
+        lyric = {"start": sub.time, "end": end_time, "text": text}
+        if words: lyric["words"] = words
+        processed_lyrics.append(lyric)
+    return LyricTimeline(processed_lyrics)
+
+
+class RenderProfiler:
+    """按阶段记录渲染热路径的耗时，汇总为分位数与直方图，可选导出 Chrome trace。"""
+    HISTOGRAM_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100)  # 直方图各桶的上界（毫秒），最后一桶为超出部分
+    _DISABLED = nullcontext()
+
+    def __init__(self, enabled=True, trace=False):
+        self.enabled = enabled
+        self.trace = trace
+        self.durations = OrderedDict()  # 阶段名 -> 每次耗时（纳秒）
+        self.events = []
+        self._origin = time.perf_counter_ns()
+
+    def span(self, name):
+        return self._span(name) if self.enabled else self._DISABLED
+
+    @contextmanager
+    def _span(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter_ns())
+
+    def record(self, name, start_ns, end_ns):
+        if not self.enabled: return
+        self.durations.setdefault(name, []).append(end_ns - start_ns)
+        if self.trace:
+            self.events.append((name, start_ns - self._origin, end_ns - start_ns, threading.get_ident()))
+
+    def summary(self):
+        result = OrderedDict()
+        for name, durations in self.durations.items():
+            ms = np.array(durations) / 1e6
+            counts = np.bincount(np.searchsorted(self.HISTOGRAM_MS, ms), minlength=len(self.HISTOGRAM_MS) + 1)
+            result[name] = {
+                "count": len(ms), "total_ms": float(ms.sum()), "mean_ms": float(ms.mean()),
+                "p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+                "max_ms": float(ms.max()), "histogram": counts.tolist()
+            }
+        return result
+
+    def summary_text(self):
+        lines = ["各阶段耗时（次数, 合计, 均值/p95/最大, 单位毫秒）:"]
+        for name, s in self.summary().items():
+            lines.append(f"  {name}: {s['count']} 次, 合计 {s['total_ms']:.0f}, "
+                         f"{s['mean_ms']:.2f}/{s['p95_ms']:.2f}/{s['max_ms']:.2f}")
+        return "\n".join(lines)
+
+    def dump_trace(self, path):
+        """写出 Chrome trace 格式（完整事件 "X"，时间单位微秒）。"""
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "ts": start / 1e3, "dur": dur / 1e3, "pid": pid, "tid": tid}
+                  for name, start, dur, tid in self.events]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
 
 
 # --- 2. 视觉元素创建函数 ---
-def create_dynamic_background(image_path, duration, video_size, blur_radius):
+def breathing_brightness(t):
+    """背景"呼吸"效果在时间 t 的亮度系数。"""
+    return 1.0 + 0.05 * np.sin(t * 0.3)
+
+
+def prepare_background(image_path, video_size, blur_radius):
+    """把封面缩放裁剪到画面大小并做高斯模糊，返回 uint8 RGB 数组。"""
     with Image.open(image_path).convert("RGB") as pil_image:
         scale = max(video_size[0] / pil_image.width, video_size[1] / pil_image.height)
         new_size = (int(pil_image.width * scale), int(pil_image.height * scale))
@@ -106,18 +364,11 @@ def create_dynamic_background(image_path, duration, video_size, blur_radius):
         top = (pil_image.height - video_size[1]) / 2
         pil_image = pil_image.crop((left, top, left + video_size[0], top + video_size[1]))
         base_blurred = pil_image.filter(ImageFilter.GaussianBlur(blur_radius))
-        base_array = np.array(base_blurred, dtype=np.float32)
-
-    def make_frame(t):
-        frame = base_array.copy()
-        brightness_factor = 1.0 + 0.05 * np.sin(t * 0.3)
-        frame *= brightness_factor
-        return np.clip(frame, 0, 255).astype('uint8')
-
-    return mpy.VideoClip(make_frame, duration=duration).set_fps(24)
+        return np.array(base_blurred, dtype=np.uint8)
 
 
-def create_cover_clip(image_path, duration, video_size, cover_size, cover_pos, corner_radius):
+def prepare_cover_layer(image_path, video_size, cover_size, cover_pos, corner_radius):
+    """生成带圆角封面的全画面 RGBA 图层。"""
     with Image.open(image_path).convert("RGBA") as img:
         img.thumbnail(cover_size, Resampling.LANCZOS)
         mask = Image.new("L", img.size, 0)
@@ -126,143 +377,1589 @@ def create_cover_clip(image_path, duration, video_size, cover_size, cover_pos, c
         frame_img = Image.new("RGBA", video_size, (0, 0, 0, 0))
         final_pos = (cover_pos[0] + (cover_size[0] - img.width) // 2, cover_pos[1] + (cover_size[1] - img.height) // 2)
         frame_img.paste(img, final_pos, img)
-        frame_array = np.array(frame_img)
-    return mpy.VideoClip(lambda t: frame_array, duration=duration).set_fps(24)
+        return np.array(frame_img)
+
+
+def create_dynamic_background(image_path, duration, video_size, blur_radius):
+    from moviepy.video.VideoClip import VideoClip
+    base_array = prepare_background(image_path, video_size, blur_radius).astype(np.float32)
+
+    def make_frame(t):
+        frame = base_array * breathing_brightness(t)
+        return np.clip(frame, 0, 255).astype('uint8')
+
+    return VideoClip(make_frame, duration=duration).set_fps(FPS)
+
+
+def create_cover_clip(image_path, duration, video_size, cover_size, cover_pos, corner_radius):
+    from moviepy.video.VideoClip import VideoClip
+    frame_array = prepare_cover_layer(image_path, video_size, cover_size, cover_pos, corner_radius)
+    return VideoClip(lambda t: frame_array, duration=duration).set_fps(FPS)
+
+
+class ArrayDiskCache:
+    """跨任务、跨进程复用的数组磁盘缓存：每个键一个 .npy 文件，命中时只读 mmap 加载，超出上限按 LRU 淘汰。"""
+
+    def __init__(self, cache_dir=None, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+
+    def _path(self, key):
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.npy")
+
+    def get_or_create(self, key, build):
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+            os.utime(path)
+            self.hits += 1
+            return array
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        array = build()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)  # 多个进程同时生成同一个键时，原子替换保证读到的总是完整文件
+            self._evict()
+        except OSError as e:
+            print(f"写入缓存失败: {e}")
+        return array
 
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npy"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
 
-def create_lyrics_clip(lyrics, duration, fonts, lang, cfg):
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cached_background(image_path, video_size, blur_radius, cache):
+    """模糊背景按 (图片内容哈希, 画面尺寸, 模糊半径) 缓存。"""
+    image_hash = file_fingerprint(image_path)["sha256"]
+    return cache.get_or_create(("background", image_hash, tuple(video_size), blur_radius),
+                               lambda: prepare_background(image_path, video_size, blur_radius))
+
+
+def cached_cover_layer(image_path, video_size, cover_size, cover_pos, corner_radius, cache):
+    """圆角封面图层按 (图片内容哈希, 画面尺寸, 封面位置与尺寸, 圆角半径) 缓存。"""
+    image_hash = file_fingerprint(image_path)["sha256"]
+    key = ("cover", image_hash, tuple(video_size), tuple(cover_size), tuple(cover_pos), corner_radius)
+    return cache.get_or_create(key, lambda: prepare_cover_layer(image_path, video_size, cover_size, cover_pos,
+                                                                corner_radius))
+
+
+def fill_scale(image_size, video_size):
+    """把图片缩放到刚好铺满画面所需的倍数。"""
+    return max(video_size[0] / image_size[0], video_size[1] / image_size[1])
+
+
+def prepare_blurred_source(image_path, scale, blur_radius):
+    """把整张封面缩放 scale 倍后做高斯模糊（不裁剪），供多个输出规格各自缩放裁剪。"""
+    with Image.open(image_path).convert("RGB") as pil_image:
+        new_size = (max(1, int(pil_image.width * scale)), max(1, int(pil_image.height * scale)))
+        blurred = pil_image.resize(new_size, Resampling.LANCZOS).filter(ImageFilter.GaussianBlur(blur_radius))
+        return np.array(blurred, dtype=np.uint8)
+
+
+def crop_to_fill(source, video_size):
+    """把图片缩放到刚好铺满 video_size 并居中裁剪。"""
+    img = Image.fromarray(np.asarray(source))
+    scale = fill_scale(img.size, video_size)
+    new_size = (max(video_size[0], int(img.width * scale)), max(video_size[1], int(img.height * scale)))
+    if new_size != img.size:
+        img = img.resize(new_size, Resampling.LANCZOS)
+    left = (img.width - video_size[0]) // 2
+    top = (img.height - video_size[1]) // 2
+    return np.array(img.crop((left, top, left + video_size[0], top + video_size[1])), dtype=np.uint8)
+
+
+def cached_backgrounds(image_path, layouts, cache):
+    """为每个布局生成模糊背景；多个规格时按最大的规格模糊一次，其余规格从中缩小裁剪。"""
+    if len(layouts) == 1:
+        return [cached_background(image_path, layouts[0]["video_size"], layouts[0]["blur_radius"], cache)]
+    with Image.open(image_path) as img:
+        image_size = img.size
+    largest = max(layouts, key=lambda layout: fill_scale(image_size, layout["video_size"]))
+    scale = fill_scale(image_size, largest["video_size"])
+    image_hash = file_fingerprint(image_path)["sha256"]
+    source = cache.get_or_create(("blurred_source", image_hash, round(scale, 6), largest["blur_radius"]),
+                                 lambda: prepare_blurred_source(image_path, scale, largest["blur_radius"]))
+    return [crop_to_fill(source, layout["video_size"]) for layout in layouts]
+
+
+class StaticLayerCompositor:
+    """背景与封面预先合成为一张底图，呼吸亮度按 1/255 档位经查找表作用于底图。"""
+
+    def __init__(self, background, cover_layer, levels_cached=8, levels=None):
+        self.levels = levels  # 逐帧亮度档位表（渲染计划中的 "brightness"），对齐整帧时直接查表
+        alpha = cover_layer[..., 3:4].astype(np.float32) / 255.0
+        flat = cover_layer[..., :3] * alpha + background * (1.0 - alpha)
+        self.base = np.clip(flat + 0.5, 0, 255).astype(np.uint8)
+        self.levels_cached = levels_cached
+        self._frames = OrderedDict()
+        self._ramp = np.arange(256, dtype=np.float32)
+
+    def brightness_level(self, t):
+        n = aligned_frame(t, len(self.levels)) if self.levels else None
+        if n is not None: return self.levels[n]
+        return int(round(breathing_brightness(t) * 255))
+
+    def frame_at(self, t):
+        """返回时间 t 的底图（只读，调用方不得原地修改）。"""
+        level = self.brightness_level(t)
+        frame = self._frames.get(level)
+        if frame is not None:
+            self._frames.move_to_end(level)
+            return frame
+        lut = np.clip(self._ramp * (level / 255.0) + 0.5, 0, 255).astype(np.uint8)
+        frame = lut[self.base]
+        frame.flags.writeable = False
+        self._frames[level] = frame
+        if len(self._frames) > self.levels_cached:
+            self._frames.popitem(last=False)
+        return frame
+
+
+class FrameBufferPool:
+    """合成用的预分配缓冲：count 块轮流使用的 uint8 帧缓冲，以及 uint16 定点运算的暂存区。"""
+
+    def __init__(self, video_size, count=2):
+        width, height = video_size
+        self.frames = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(count)]
+        self._next = 0
+        # 暂存区按 (高, 宽×3) 分配：混合时按通道取 (高, 宽) 的子区域，淡入淡出时整帧展平使用
+        self.acc = np.empty((height, width * 3), dtype=np.uint16)
+        self.tmp = np.empty((height, width * 3), dtype=np.uint16)
+        self.alpha = np.empty((height, width), dtype=np.uint16)
+        self.inv_alpha = np.empty((height, width), dtype=np.uint16)
+
+    def next_frame(self):
+        """返回下一块帧缓冲，它在之后第 count 次取用时被覆盖。"""
+        frame = self.frames[self._next]
+        self._next = (self._next + 1) % len(self.frames)
+        return frame
+
+
+def blend_over(dst, src, pool):
+    """把 RGBA 的 src 以 "over" 方式原地混合到 RGB 的 dst 上，在 pool 的暂存区中做 uint16 定点运算。"""
+    h, w = dst.shape[:2]
+    acc, tmp = pool.acc[:h, :w], pool.tmp[:h, :w]
+    alpha, inv_alpha = pool.alpha[:h, :w], pool.inv_alpha[:h, :w]
+    np.copyto(alpha, src[..., 3])
+    np.subtract(255, alpha, out=inv_alpha)
+    for c in range(3):
+        np.multiply(src[..., c], alpha, out=acc)
+        np.multiply(dst[..., c], inv_alpha, out=tmp)
+        acc += tmp
+        acc += 128
+        np.right_shift(acc, 8, out=tmp)
+        acc += tmp
+        acc >>= 8
+        np.copyto(dst[..., c], acc, casting="unsafe")
+
+
+def scale_in_place(frame, factor, pool):
+    """整帧乘以 [0, 1] 内的系数（淡入淡出），以 1/256 定点标量乘法原地完成。"""
+    h, w = frame.shape[:2]
+    flat, acc = frame.reshape(h, w * 3), pool.acc[:h, :w * 3]
+    np.multiply(flat, np.uint16(round(min(max(factor, 0.0), 1.0) * 256)), out=acc)
+    acc >>= 8
+    np.copyto(flat, acc, casting="unsafe")
+
+
+def aligned_frame(t, count, fps=FPS):
+    """t 恰好落在第 n 个整帧上且 n < count 时返回 n，否则返回 None。"""
+    n = int(round(t * fps))
+    return n if abs(n - t * fps) < 1e-6 and 0 <= n < count else None
+
+
+def build_scroll_curve(lyrics, targets, fps=FPS, easing=SCROLL_EASING):
+    """把逐帧缓动的滚动位置改写为时间 t 的闭式函数，任意帧可独立计算。"""
+    decay = 1.0 - easing
+    start_scroll = []
+    scroll = 0.0
+    for i, lyric in enumerate(lyrics):
+        start_scroll.append(scroll)
+        # 上一句歌词播放期间的缓动在下一句开始时结算，作为下一句的起点
+        active_end = min(lyric["end"], lyrics[i + 1]["start"]) if i + 1 < len(lyrics) else lyric["end"]
+        frames = max(0.0, (active_end - lyric["start"]) * fps)
+        scroll = targets[i] - (targets[i] - scroll) * decay ** frames
+
+    def scroll_at(idx, t):
+        frames = max(0.0, (t - lyrics[idx]["start"]) * fps) + 1
+        return targets[idx] - (targets[idx] - start_scroll[idx]) * decay ** frames
+
+    return scroll_at
+
+
+class LineSpriteCache:
+    """有界 LRU 缓存，按 (文本, 字体, 颜色) 保存已带阴影的行精灵。"""
+
+    def __init__(self, shadow_offset=2, max_items=1024):
+        self.shadow_offset = shadow_offset
+        self.max_items = max_items
+        self.hits = self.misses = 0
+        self._sprites = OrderedDict()
+
+    def get(self, text, font, color):
+        key = (text, font.path, font.size, color)
+        sprite = self._sprites.get(key)
+        if sprite is not None:
+            self.hits += 1
+            self._sprites.move_to_end(key)
+            return sprite
+        self.misses += 1
+        sprite = self._rasterize(text, font, color)
+        self._sprites[key] = sprite
+        if len(self._sprites) > self.max_items:
+            self._sprites.popitem(last=False)
+        return sprite
+
+    def _rasterize(self, text, font, color):
+        _, _, width, height = font.getbbox(text)
+        off = self.shadow_offset
+        img = Image.new("RGBA", (max(width, 0) + off, max(height, 0) + off), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.text((off, off), text, font=font, fill=(0, 0, 0, int(color[3] * 0.4)))
+        draw.text((0, 0), text, font=font, fill=color)
+        arr = np.array(img)
+        return {"rgb": arr[..., :3].copy(), "alpha": arr[..., 3].copy(), "width": width, "height": height}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._sprites)}
+
+
+def blit_sprite(layer, sprite, x, y, opacity, columns=None):
+    """把精灵按透明度贴到 RGBA 图层上，超出画面的部分被裁掉；返回实际写入的矩形 (x0, y0, x1, y1)。
+    columns=(c0, c1) 时只贴精灵的这几列（卡拉 OK 擦除时已唱与未唱的部分分别取自两张精灵）。"""
+    alpha = sprite["alpha"]
+    h, w = alpha.shape
+    c0, c1 = columns or (0, w)
+    x0, y0 = max(x + c0, 0), max(y, 0)
+    x1, y1 = min(x + min(c1, w), layer.shape[1]), min(y + h, layer.shape[0])
+    if x0 >= x1 or y0 >= y1: return None
+    src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    # 各行之间有行距，精灵矩形互不重叠，直接写入即可
+    layer[y0:y1, x0:x1, :3] = sprite["rgb"][src]
+    layer[y0:y1, x0:x1, 3] = (alpha[src].astype(np.uint16) * int(opacity * 256)) >> 8
+    return x0, y0, x1, y1
+
+
+def union_rect(a, b):
+    if a is None: return b
+    if b is None: return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def wrap_lyrics(lyrics, font, lang, max_width, segmenter=None):
+    """对整首歌词换行，返回每句歌词的 {"lines", "heights"}；segmenter 为分词缓存，默认使用 CACHE_DIR 中的。"""
+    layout_engine = get_layout_engine(font, lang, segmenter)
+    wrapped = [layout_engine.layout(lyric["text"], max_width) for lyric in lyrics]
+    layout_engine.segmenter.save()
+    return wrapped
+
+
+def karaoke_wipe_keys(lyric, lines, font):
+    """把一句的逐字时间换算成擦除关键帧，返回 (时间数组, 擦除位置数组, 各行在擦除轴上的起点)。
+
+    擦除轴把该句换行后的各行首尾相接，位置按字形前进宽度计算（取整到像素）。第 k 个字开始时擦到它的起始字符，
+    相邻两个时间点之间线性推进；第一个标签不在句首时从句子开始由 0 推进到它，最后一个字一直推进到句末。"""
+    text = lyric["text"]
+    starts, lefts, pos, left = [], [], 0, 0.0
+    for line in lines:
+        found = text.find(line, pos)
+        pos = found if found >= 0 else pos
+        starts.append(pos)
+        lefts.append(int(round(left)))
+        pos += len(line)
+        left += font.getlength(line)
+
+    def axis(offset):
+        j = max(0, bisect.bisect_right(starts, offset) - 1)
+        local = min(max(offset - starts[j], 0), len(lines[j]))
+        return lefts[j] + font.getlength(lines[j][:local])
+
+    keys = [(time, axis(offset)) for time, offset in lyric["words"]]
+    if keys[0][1] > 0: keys.insert(0, (lyric["start"], 0.0))
+    if keys[-1][1] < left: keys.append((max(lyric["end"], keys[-1][0]), left))
+    times = np.maximum.accumulate(np.array([k[0] for k in keys], dtype=np.float64))
+    return times, np.array([k[1] for k in keys], dtype=np.float64), lefts
+
+
+def create_lyrics_clip(lyrics, duration, fonts, lang, cfg, sprite_cache=None, wrapped=None, frames=None):
+    """创建歌词图层；wrapped 为已换好的行（见 wrap_lyrics），frames 为渲染计划中的逐帧状态表。"""
     font_lyric, font_small = fonts["bold"], fonts["regular"]
-    lyric_details = []
-    cumulative_y = 0
-    for lyric in lyrics:
-        lines = wrap_text(lyric["text"], font_lyric, cfg['area_width'], lang)
-        height = sum(font_lyric.getbbox(l)[3] + cfg['line_spacing'] for l in lines) - cfg['line_spacing']
-        lyric_details.append({"lines": lines, "y_pos": cumulative_y, "height": height})
-        cumulative_y += height + cfg['lyric_spacing']
+    sprites = sprite_cache or LineSpriteCache(cfg.get('shadow_offset', 2))
+    timeline = lyrics if isinstance(lyrics, LyricTimeline) else LyricTimeline(lyrics)
+    wrapped = wrapped or wrap_lyrics(timeline, font_lyric, lang, cfg['area_width'])
+    # 版面存成数组：每句的 y、高度和中心（中心随句子单调递增，可按滚动窗口二分查找可见的句子）
+    block_h = np.array([sum(h + cfg['line_spacing'] for h in m["heights"]) - cfg['line_spacing'] for m in wrapped],
+                       dtype=np.int64)
+    block_y = np.concatenate(([0], np.cumsum(block_h + cfg['lyric_spacing'])[:-1])).astype(np.int64)
+    centers = block_y + block_h / 2
+    # 所有行展平：第 i 句的行是 lines[line_start[i]:line_start[i + 1]]
+    lines = [line for m in wrapped for line in m["lines"]]
+    line_start = np.cumsum([0] + [len(m["lines"]) for m in wrapped]).tolist()
 
-    current_scroll_y = 0.0
+    def line_metrics(font):
+        """按绘制字体量出每行的高度和在句内的 y 偏移（高亮句与普通句字号不同，行高也不同）。"""
+        heights = np.array([font.getbbox(line)[3] for line in lines], dtype=np.int64)
+        step = np.cumsum(heights + cfg['line_spacing']) - (heights + cfg['line_spacing'])
+        offsets = step - np.repeat(step[line_start[:-1]], np.diff(line_start))
+        return offsets.tolist(), heights.tolist()
 
-    def make_frame(t):
-        nonlocal current_scroll_y
-        frame = Image.new("RGBA", cfg['video_size'], (0, 0, 0, 0))
-        draw = ImageDraw.Draw(frame)
-        idx = next((i for i, l in enumerate(lyrics) if l["start"] <= t < l["end"]), -1)
-        if idx == -1: return np.array(frame)
-
-        details = lyric_details[idx]
-        target_scroll_y = details["y_pos"] + details["height"] / 2
-        current_scroll_y += (target_scroll_y - current_scroll_y) * 0.08
+    metrics_hl, metrics_std = line_metrics(font_lyric), line_metrics(font_small)
+    # 带逐字时间的句子：预先算好擦除关键帧，播放时已唱部分取高亮精灵、未唱部分取同字号的普通色精灵，按列拼接
+    wipes = {i: karaoke_wipe_keys(lyric, lines[line_start[i]:line_start[i + 1]], font_lyric)
+             for i, lyric in enumerate(timeline) if lyric.get("words")}
+
+    def wipe_at(idx, t):
+        """当前句的擦除位置（像素）；没有逐字时间的句子返回 None。"""
+        if idx not in wipes: return None
+        times, positions, _ = wipes[idx]
+        return int(round(float(np.interp(t, times, positions))))
+
+    block_y_list = block_y.tolist()
+    targets = centers.tolist()
+    scroll_at = build_scroll_curve(timeline, targets)
+    frame_w, frame_h = cfg['video_size']
+    # 歌词只画在歌词区域内（竖屏时不会盖住上方的封面）；横屏的歌词区域就是整个画面高度
+    area_top, area_h = cfg['area_y'], cfg['area_height']
+    reach = area_h / 2.5  # 离当前滚动位置超过这个距离的句子完全透明
+
+    def scroll_state(idx, t):
+        """返回 (滚动位置, 是否已停稳)；停稳后直接吸附到目标位置，保证之后的帧完全一致。"""
+        scroll = scroll_at(idx, t)
+        if abs(targets[idx] - scroll) < SCROLL_SETTLE_PX:
+            return targets[idx], True
+        return scroll, False
+
+    def visible_range(scroll):
+        """只有中心落在 (滚动位置 ± reach) 内的句子可见，二分找出这段区间 [lo, hi)。"""
+        scroll = np.asarray(scroll)
+        return (np.searchsorted(centers, scroll - reach, side="right"),
+                np.searchsorted(centers, scroll + reach, side="left"))
+
+    def live_state(idx, t):
+        if idx == -1: return -1, 0.0, True, None
+        scroll, settled = scroll_state(idx, t)
+        return idx, scroll, settled, wipe_at(idx, t)
+
+    if frames is None:
+        # 整首歌每个整帧的图层状态：一次 searchsorted 算出每帧的当前歌词，可见区间也整列二分
+        active = timeline.indices_at(np.arange(int(np.ceil(duration * FPS)) + 1) / FPS).tolist()
+        states = [live_state(idx, n / FPS) for n, idx in enumerate(active)]
+        scrolls = [state[1] for state in states]
+        lo, hi = visible_range(scrolls)
+        hi = np.where(np.asarray(active) == -1, lo, hi)
+        frames = {"active": active, "scroll": scrolls, "settled": [state[2] for state in states],
+                  "wipe": [state[3] for state in states], "visible": np.stack([lo, hi], axis=1).tolist()}
+
+    def layer_state(t):
+        """返回 (当前句, 滚动位置, 是否已停稳, 擦除位置, 可见区间)，整帧时刻直接查表。"""
+        n = aligned_frame(t, len(frames["active"]))
+        if n is not None:
+            return (frames["active"][n], frames["scroll"][n], frames["settled"][n], frames["wipe"][n],
+                    frames["visible"][n])
+        idx, scroll, settled, wipe = live_state(timeline.index_at(t), t)
+        lo, hi = visible_range(scroll) if idx != -1 else (0, 0)
+        return idx, scroll, settled, wipe, (int(lo), int(hi))
+
+    def state_key(t):
+        """图层静止时返回状态键（相同键的帧内容相同），仍在滚动时返回 None。"""
+        idx, _, settled, wipe, _ = layer_state(t)
+        if idx == -1: return -1
+        if not settled: return None
+        return idx if wipe is None else (idx, wipe)
+
+    layer = np.zeros((frame_h, frame_w, 4), dtype=np.uint8)
+    area = layer[area_top:area_top + area_h]
+    dirty_rect = None  # 上一帧写过的区域，下一帧只需清空这里
+
+    def render_layer(t):
+        """渲染歌词图层，返回 (复用的图层缓冲, 本帧有内容的矩形或 None)。"""
+        nonlocal dirty_rect
+        if dirty_rect:
+            x0, y0, x1, y1 = dirty_rect
+            layer[y0:y1, x0:x1] = 0
+        dirty_rect = None
+        idx, current_scroll_y, _, wipe, (lo, hi) = layer_state(t)
+        if idx == -1: return layer, None
         draw_origin_y = cfg['area_y'] + cfg['area_height'] / 2 - current_scroll_y
 
-        for i, details in enumerate(lyric_details):
-            y, is_hl = draw_origin_y + details["y_pos"], (i == idx)
+        # 可见区间内各句的透明度一次算完
+        factors = (1 - np.abs(centers[lo:hi] - current_scroll_y) / reach) ** 2
+        for i, distance_factor in zip(range(lo, hi), factors.tolist()):
+            is_hl = (i == idx)
             font = font_lyric if is_hl else font_small
             color = cfg['color_hl'] if is_hl else cfg['color_std']
-            pixel_dist = abs((details['y_pos'] + details['height'] / 2) - current_scroll_y)
-            distance_factor = max(0, 1 - pixel_dist / (cfg['video_size'][1] / 2.5)) ** 2
-            alpha = int(color[3] * distance_factor)
-            final_color = (*color[:3], alpha)
-            line_y = y
-            for line in details["lines"]:
-                line_height = font.getbbox(line)[3]
-                if not (line_y + line_height > 0 and line_y < cfg['video_size'][1]):
-                    line_y += line_height + cfg['line_spacing']
-                    continue
-                tw = font.getbbox(line)[2]
-                x = cfg['area_x'] + (cfg['area_width'] - tw) / 2
-                shadow_color = (*cfg['shadow_color'][:3], int(alpha * 0.4))
-                draw.text((x + 2, line_y + 2), line, font=font, fill=shadow_color)
-                draw.text((x, line_y), line, font=font, fill=final_color)
-                line_y += line_height + cfg['line_spacing']
-        return np.array(frame)
-
-    return mpy.VideoClip(make_frame, duration=duration).set_fps(24)
-
-
-# --- 3. 主生成函数 ---
-def generate_music_video(audio_path, lyrics_path, cover_path, output_path, progress_callback=None):
-    def progress(p, msg):
-        if progress_callback: progress_callback(p, msg)
-
-    # 布局固定为 16:9
-    VIDEO_WIDTH, VIDEO_HEIGHT = 1280, 720
-    cover_size_h = int(VIDEO_HEIGHT * 0.6)
-    cover_size_w = cover_size_h
-    cover_pos_x = int(VIDEO_WIDTH * 0.08)
-    cover_pos_y = (VIDEO_HEIGHT - cover_size_h) // 2
-    lyrics_config = {
-        'area_x': cover_pos_x + cover_size_w + int(VIDEO_WIDTH * 0.05),
-        'area_y': 0,
-        'area_width': VIDEO_WIDTH - (cover_pos_x + cover_size_w + int(VIDEO_WIDTH * 0.13)),
-        'area_height': VIDEO_HEIGHT
-    }
+            offsets, heights = metrics_hl if is_hl else metrics_std
+            line_wipe = wipe if is_hl else None
+            y = draw_origin_y + block_y_list[i]
+            for j in range(line_start[i], line_start[i + 1]):
+                line_y = y + offsets[j]
+                if line_y + heights[j] > area_top and line_y < area_top + area_h:
+                    sprite = sprites.get(lines[j], font, color)
+                    x = int(round(cfg['area_x'] + (cfg['area_width'] - sprite["width"]) / 2))
+                    top = int(round(line_y)) - area_top
+                    if line_wipe is None:
+                        rect = blit_sprite(area, sprite, x, top, distance_factor)
+                    else:
+                        split = max(0, line_wipe - wipes[i][2][j - line_start[i]])
+                        pending = sprites.get(lines[j], font, cfg['color_std'])
+                        rect = union_rect(blit_sprite(area, sprite, x, top, distance_factor, columns=(0, split)),
+                                          blit_sprite(area, pending, x, top, distance_factor,
+                                                      columns=(split, pending["alpha"].shape[1])))
+                    if rect:
+                        rect = (rect[0], rect[1] + area_top, rect[2], rect[3] + area_top)
+                    dirty_rect = union_rect(dirty_rect, rect)
+        return layer, dirty_rect
+
+    from moviepy.video.VideoClip import VideoClip
+    clip = VideoClip(lambda t: render_layer(t)[0].copy(), duration=duration).set_fps(FPS)
+    clip.sprite_cache = sprites
+    clip.render_layer = render_layer
+    clip.state_key = state_key
+    clip.frame_states = frames
+    return clip
+
+
+# --- 3. 渲染管线 ---
+OUTPUT_PROFILES = {"1080p": (1920, 1080), "720p": (1280, 720), "vertical": (1080, 1920)}
+DEFAULT_PROFILE = "720p"
+
+
+def render_layout(scale=1.0, video_size=OUTPUT_PROFILES[DEFAULT_PROFILE]):
+    """按输出分辨率（以短边 720 为基准）和缩放比例计算画面布局；横屏封面在左，竖屏封面在上。"""
+    unit = scale * min(video_size) / 720
+
+    def scaled(value):
+        return max(1, int(round(value * unit)))
+
+    # 宽高取偶数以满足 yuv420p
+    VIDEO_WIDTH = max(2, int(round(video_size[0] * scale)) // 2 * 2)
+    VIDEO_HEIGHT = max(2, int(round(video_size[1] * scale)) // 2 * 2)
+    if VIDEO_WIDTH >= VIDEO_HEIGHT:
+        cover_size_h = int(VIDEO_HEIGHT * 0.6)
+        cover_size_w = cover_size_h
+        cover_pos_x = int(VIDEO_WIDTH * 0.08)
+        cover_pos_y = (VIDEO_HEIGHT - cover_size_h) // 2
+        lyrics_config = {
+            'area_x': cover_pos_x + cover_size_w + int(VIDEO_WIDTH * 0.05),
+            'area_y': 0,
+            'area_width': VIDEO_WIDTH - (cover_pos_x + cover_size_w + int(VIDEO_WIDTH * 0.13)),
+            'area_height': VIDEO_HEIGHT
+        }
+    else:
+        cover_size_w = int(VIDEO_WIDTH * 0.6)
+        cover_size_h = cover_size_w
+        cover_pos_x = (VIDEO_WIDTH - cover_size_w) // 2
+        cover_pos_y = int(VIDEO_HEIGHT * 0.08)
+        area_y = cover_pos_y + cover_size_h + int(VIDEO_HEIGHT * 0.04)
+        lyrics_config = {
+            'area_x': int(VIDEO_WIDTH * 0.08),
+            'area_y': area_y,
+            'area_width': VIDEO_WIDTH - 2 * int(VIDEO_WIDTH * 0.08),
+            'area_height': VIDEO_HEIGHT - area_y - int(VIDEO_HEIGHT * 0.04)
+        }
 
     VIDEO_SIZE = (VIDEO_WIDTH, VIDEO_HEIGHT)
-    FONT_SIZE_LYRIC, FONT_SIZE_SMALL = (50, 38)
+    FONT_SIZE_LYRIC, FONT_SIZE_SMALL = (scaled(50), scaled(38))
     lyrics_config.update({
-        'video_size': VIDEO_SIZE, 'line_spacing': 15, 'lyric_spacing': 30,
+        'video_size': VIDEO_SIZE, 'line_spacing': scaled(15), 'lyric_spacing': scaled(30),
         'color_std': (255, 255, 255, 180), 'color_hl': (255, 255, 255, 255),
-        'shadow_color': (0, 0, 0, 160)
+        'shadow_color': (0, 0, 0, 160), 'shadow_offset': scaled(2)
     })
+    return {
+        "video_size": VIDEO_SIZE, "cover_size": (cover_size_w, cover_size_h), "cover_pos": (cover_pos_x, cover_pos_y),
+        "corner_radius": int(cover_size_w * 0.12), "blur_radius": scaled(60),
+        "font_sizes": (FONT_SIZE_LYRIC, FONT_SIZE_SMALL), "lyrics": lyrics_config
+    }
 
-    audio_clip = background = cover = lyrics = final_clip = None
-    try:
-        progress(0, "准备中...")
-        audio_clip = mpy.AudioFileClip(audio_path)
-        duration = audio_clip.duration
-        progress(5, "解析歌词...")
+
+def resolve_profile(profile):
+    """输出规格可以是 OUTPUT_PROFILES 中的名称，也可以直接给出 (宽, 高)。"""
+    if isinstance(profile, str):
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"未知的输出规格: {profile}（可选: {', '.join(OUTPUT_PROFILES)}）")
+        return OUTPUT_PROFILES[profile]
+    width, height = profile
+    return int(width), int(height)
+
+
+def profile_output_paths(output_path, profiles=None):
+    """各输出规格的文件路径：只有一个规格时就是 output_path，多个规格时在文件名后追加规格名。"""
+    if not profiles or len(profiles) == 1: return [output_path]
+    stem, ext = os.path.splitext(output_path)
+    names = [p if isinstance(p, str) else "{}x{}".format(*resolve_profile(p)) for p in profiles]
+    return [f"{stem}_{name}{ext}" for name in names]
+
+
+RENDER_VERSION = 5  # 画面效果或编码参数变化时递增，使旧的输出和渲染计划全部失效
+PLAN_VERSION = 2  # 渲染计划的结构或换行规则变化时递增，旧计划不再沿用
+
+
+def render_plan_path(output_path):
+    """渲染计划与输出放在一起：song.mp4 -> song.plan.json（多规格输出共用一个计划）。"""
+    return os.path.splitext(output_path)[0] + ".plan.json"
+
+
+def _plan_key(layout):
+    # 布局写进 JSON 后元组变成列表，按 JSON 形式比较
+    return json.dumps(layout, sort_keys=True)
+
+
+def _wrap_key(layout):
+    return layout["font_sizes"][0], layout["lyrics"]["area_width"]
+
+
+def _plan_inputs(lyrics_path, cover_path, lang, known=None):
+    """渲染计划依赖的输入文件指纹：歌词、封面与该语言的字体。路径、大小和修改时间都没变时沿用 known 中的哈希。"""
+    known = known or {}
+    paths = {"lyrics": lyrics_path, "cover": cover_path}
+    paths.update({f"font_{style}": path for style, path in font_paths(lang, "Fonts").items() if os.path.exists(path)})
+    fingerprints = {}
+    for name, path in paths.items():
+        record = known.get(name)
+        fingerprints[name] = file_fingerprint(path, record if record and record.get("path") == path else None)
+    return fingerprints
+
+
+def compile_render_plan(lyrics_path, cover_path, duration, layouts, progress=None, base=None, fonts=None,
+                        segmenter=None):
+    """编译可写成 JSON 的渲染计划：歌词、语言、逐帧亮度，以及每个布局的换行和逐帧图层状态。
+    base 为仍然有效的旧计划时只补齐缺少的布局；fonts 为 {字号: 字体}，加载过的字体留给调用方复用。"""
+    report = progress or (lambda p, msg: None)
+    fonts = {} if fonts is None else fonts
+    known = {_plan_key(entry["layout"]): entry for entry in base["layouts"]} if base else {}
+    pending = [layout for layout in layouts if _plan_key(layout) not in known]
+    if base and not pending: return base
+
+    if base:
+        lyrics_data, lang = LyricTimeline(base["lyrics"]), base["lang"]
+    else:
+        report(5, "解析歌词...")
         lyrics_data = parse_lyrics(lyrics_path, duration)
         if not lyrics_data: raise ValueError("歌词文件为空或无法解析。")
+        report(10, "检测语言并加载字体...")
+        lang = detect_language(" ".join([l['text'] for l in lyrics_data]))
+    for layout in pending:
+        if layout["font_sizes"] not in fonts:
+            fonts[layout["font_sizes"]] = load_fonts(lang, "Fonts", *layout["font_sizes"])
+
+    # 换行只取决于字号和歌词区宽度：两者都相同的布局（包括 base 中的）共用一次换行，其余布局各自换行，
+    # 这样每个规格的输出与单独渲染它时相同，不受同时选了哪些规格影响
+    wrapped = {_wrap_key(entry["layout"]): entry["wrapped"] for entry in known.values()}
+    entries = {}
+    for layout in pending:
+        layout_fonts = fonts[layout["font_sizes"]]
+        if _wrap_key(layout) not in wrapped:
+            wrapped[_wrap_key(layout)] = wrap_lyrics(lyrics_data, layout_fonts["bold"], lang,
+                                                     layout["lyrics"]["area_width"], segmenter)
+        layout_wrapped = wrapped[_wrap_key(layout)]
+        clip = create_lyrics_clip(lyrics_data, duration, layout_fonts, lang, layout["lyrics"], wrapped=layout_wrapped)
+        entries[_plan_key(layout)] = {"layout": layout, "wrapped": layout_wrapped, "frames": clip.frame_states}
+        _close_clips([clip])
+
+    frame_count = int(np.ceil(duration * FPS)) + 1
+    return {
+        "version": PLAN_VERSION, "render_version": RENDER_VERSION, "fps": FPS, "duration": float(duration),
+        "inputs": base["inputs"] if base else _plan_inputs(lyrics_path, cover_path, lang),
+        "lang": lang, "lyrics": [dict(lyric) for lyric in lyrics_data],
+        "brightness": base["brightness"] if base else
+        [int(round(breathing_brightness(n / FPS) * 255)) for n in range(frame_count)],
+        "layouts": list({**known, **entries}.values())
+    }
+
+
+def save_render_plan(plan, path):
+    """先写临时文件再替换，中途失败不会留下半个计划；写不进去时只打印提示，不影响渲染。"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(plan, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"写入渲染计划失败: {e}")
+
+
+def load_render_plan(path, lyrics_path, cover_path, duration):
+    """读取 path 处的渲染计划。计划或渲染版本、帧率、时长变化，或歌词、封面、字体文件内容变化时返回 None。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        if (plan["version"], plan["render_version"], plan["fps"]) != (PLAN_VERSION, RENDER_VERSION, FPS):
+            return None
+        if abs(plan["duration"] - duration) > 1e-6: return None
+        inputs = _plan_inputs(lyrics_path, cover_path, plan["lang"], plan["inputs"])
+        if {k: v["sha256"] for k, v in inputs.items()} != {k: v["sha256"] for k, v in plan["inputs"].items()}:
+            return None
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    plan["inputs"] = inputs
+    return plan
+
+
+def build_render_pipeline(lyrics_path, cover_path, duration, progress=None, scale=1.0, array_cache=None,
+                          profiler=None, video_size=OUTPUT_PROFILES[DEFAULT_PROFILE], plan=None, segmenter=None):
+    """创建单个规格的渲染管线，返回 (合成单帧的函数, 需要关闭的图层列表)；scale 为预览缩放比例。"""
+    compose_frames, clips = build_render_pipelines(lyrics_path, cover_path, duration,
+                                                   [render_layout(scale, video_size)], progress, array_cache, profiler,
+                                                   plan, segmenter)
+    return compose_frames[0], clips
+
+
+def build_render_pipelines(lyrics_path, cover_path, duration, layouts, progress=None, array_cache=None,
+                           profiler=None, plan=None, segmenter=None):
+    """为多个布局建立渲染管线，返回 (每个布局的合成函数列表, 需要关闭的图层列表)；plan 不全时在此补齐。"""
+    report = progress or (lambda p, msg: None)
+    fonts = {}
+    plan = compile_render_plan(lyrics_path, cover_path, duration, layouts, progress, base=plan, fonts=fonts,
+                               segmenter=segmenter)
+    for layout in layouts:
+        if layout["font_sizes"] not in fonts:
+            fonts[layout["font_sizes"]] = load_fonts(plan["lang"], "Fonts", *layout["font_sizes"])
+    lyrics_data = LyricTimeline(plan["lyrics"])
+    entries = {_plan_key(entry["layout"]): entry for entry in plan["layouts"]}
+
+    report(15, "创建视觉元素...")
+    array_cache = array_cache or ArrayDiskCache()
+    backgrounds = cached_backgrounds(cover_path, layouts, array_cache)
+    compose_frames, clips = [], []
+    for layout, background in zip(layouts, backgrounds):
+        entry = entries[_plan_key(layout)]
+        compositor = StaticLayerCompositor(
+            background, cached_cover_layer(cover_path, layout["video_size"], layout["cover_size"],
+                                           layout["cover_pos"], layout["corner_radius"], array_cache),
+            levels=plan["brightness"])
+        lyrics = create_lyrics_clip(lyrics_data, duration, fonts[layout["font_sizes"]], plan["lang"],
+                                    layout["lyrics"], wrapped=entry["wrapped"], frames=entry["frames"])
+        compose_frames.append(_make_compose_frame(compositor, lyrics, duration, layout["video_size"], profiler))
+        clips.append(lyrics)
+    return compose_frames, clips
+
+
+def _make_compose_frame(compositor, lyrics, duration, video_size, profiler=None):
+    profiler = profiler or RenderProfiler(enabled=False)
+    VIDEO_WIDTH, VIDEO_HEIGHT = video_size
+    blend_stats = {"frames": 0, "blended_pixels": 0, "max_blended_pixels": 0,
+                   "frame_pixels": VIDEO_WIDTH * VIDEO_HEIGHT, "held_frames": 0}
+    fade_in, fade_out = 1.5, 2.5
+    held_key = held_frame = None
+    pool = FrameBufferPool(video_size)
+
+    def compose_frame(t):
+        """返回时间 t 的画面。帧来自 pool 的复用缓冲，调用方需在下一次调用之前用完或自行拷贝。"""
+        nonlocal held_key, held_frame
+        # 滚动已停稳、当前句未变、亮度档位相同且不在淡入淡出区间时，画面与上一帧完全相同，直接复用
+        lyric_key = lyrics.state_key(t)
+        if lyric_key is not None and fade_in <= t <= duration - fade_out:
+            key = (compositor.brightness_level(t), lyric_key)
+            if key == held_key:
+                blend_stats["held_frames"] += 1
+                return held_frame
+        else:
+            key = None
+
+        with profiler.span("静态图层"):
+            result = pool.next_frame()
+            np.copyto(result, compositor.frame_at(t))
+        # 只在歌词图层本帧有内容的矩形内做 alpha 混合，其余像素直接沿用底图
+        with profiler.span("歌词图层"):
+            lyrics_layer, rect = lyrics.render_layer(t)
+        blended = 0
+        if rect:
+            with profiler.span("歌词混合"):
+                x0, y0, x1, y1 = rect
+                blend_over(result[y0:y1, x0:x1], lyrics_layer[y0:y1, x0:x1], pool)
+            blended = (x1 - x0) * (y1 - y0)
+        blend_stats["frames"] += 1
+        blend_stats["blended_pixels"] += blended
+        blend_stats["max_blended_pixels"] = max(blend_stats["max_blended_pixels"], blended)
+
+        if t < fade_in or t > duration - fade_out:
+            with profiler.span("淡入淡出"):
+                scale_in_place(result, t / fade_in if t < fade_in else (duration - t) / fade_out, pool)
+        held_key, held_frame = key, result
+        return result
+
+    compose_frame.sprite_cache = lyrics.sprite_cache
+    compose_frame.blend_stats = blend_stats
+    compose_frame.video_size = tuple(video_size)
+    return compose_frame
+
+
+def _close_clips(clips):
+    for clip in clips:
+        if clip:
+            try:
+                clip.close()
+            except Exception:
+                pass
+
+
+# --- 4. 编码后端 ---
+VFR_FILTER = "mpdecimate=hi=0:lo=0:frac=0:max=0"
+MP4_AUDIO_COPY_CODECS = {"aac", "mp3", "alac", "ac3", "eac3"}  # MP4 可以直接封装、无需转码的音频编码
+
+
+def x264_params(variable_frame_rate=False, crf=22):
+    """libx264 的公共输出参数。可变帧率时用 mpdecimate 丢掉与上一帧完全相同的帧，
+    静止区间在 MP4 中只保留一帧并拉长其时长，编码器也不再处理这些重复帧。"""
+    params = ["-crf", str(crf), "-pix_fmt", "yuv420p"]
+    if variable_frame_rate:
+        params += ["-vf", VFR_FILTER, "-vsync", "vfr"]
+    return params
+
+
+class FFmpegPipeEncoder:
+    """把 uint8 RGB 帧直接写入 ffmpeg -f rawvideo 的标准输入，音频在同一个 ffmpeg 进程里从源文件混入。
+    audio_copy 为 True 时原样封装源音频流，否则在同一进程中转码为 AAC，都不产生临时文件。
+
+    帧先拷进一块预分配的批量缓冲，攒满 batch_frames 帧后一次性写入管道，减少系统调用次数。
+    """
+
+    def __init__(self, output_path, video_size, audio_path=None, threads=None, preset="medium",
+                 variable_frame_rate=False, batch_frames=8, fps=FPS, crf=22, audio_range=None, audio_copy=False):
+        width, height = video_size
+        cmd = [
+            ffmpeg_binary(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-vcodec", "rawvideo", "-s", f"{width}x{height}", "-pix_fmt", "rgb24",
+            "-r", str(fps), "-i", "-"
+        ]
+        if audio_path:
+            if audio_range:
+                cmd += ["-ss", f"{audio_range[0]:.3f}", "-t", f"{audio_range[1] - audio_range[0]:.3f}"]
+            cmd += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "copy" if audio_copy else "aac"]
+        cmd += ["-c:v", "libx264", "-preset", preset, "-threads", str(threads or os.cpu_count() or 1)]
+        cmd += x264_params(variable_frame_rate, crf) + [output_path]
+        self.output_path = output_path
+        self.offsets = [0, height]
+        self._start(cmd, np.empty((batch_frames, height, width, 3), dtype=np.uint8))
+
+    def _start(self, cmd, batch):
+        self.frame_shape = batch.shape[1:]
+        self._batch = batch
+        self._pending = 0
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE)
+
+    def write_frame(self, frame):
+        self._batch[self._pending] = frame
+        self._pending += 1
+        if self._pending == len(self._batch):
+            self._flush()
+
+    def _flush(self):
+        if not self._pending: return
+        self._write(memoryview(self._batch[:self._pending]).cast("B"))
+        self._pending = 0
+
+    def _write(self, data):
+        try:
+            self._proc.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            raise IOError(f"ffmpeg 编码失败: {self._proc.stderr.read().decode('utf-8', 'ignore').strip()}")
+
+    def write_raw(self, data):
+        """把已按输入格式排好的一段连续原始帧（如共享内存中的连续槽位）直接写入管道，不经过批量缓冲。"""
+        self._flush()
+        self._write(data)
+
+    def close(self):
+        self._flush()
+        self._proc.stdin.close()
+        err = self._proc.stderr.read()
+        self._proc.stderr.close()
+        if self._proc.wait() != 0:
+            raise IOError(f"ffmpeg 编码失败: {err.decode('utf-8', 'ignore').strip()}")
+
+    def abort(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        for pipe in (self._proc.stdin, self._proc.stderr):
+            try:
+                pipe.close()
+            except OSError:  # 进程已结束，stdin 中未写出的数据无法再送出
+                pass
+
+
+def stack_frames(slot, frames, offsets):
+    """把各规格的帧按 offsets 上下拼进一张编码器输入帧，较窄的帧靠左放置。"""
+    for frame, top in zip(frames, offsets):
+        slot[top:top + frame.shape[0], :frame.shape[1]] = frame
+
+
+class FFmpegMultiOutputEncoder(FFmpegPipeEncoder):
+    """一个 ffmpeg 进程编码多个规格：各规格的帧上下拼接写入管道，再裁剪回各自的输出 [(路径, (宽, 高)), ...]。"""
+
+    def __init__(self, outputs, audio_path=None, threads=None, preset="medium", variable_frame_rate=False,
+                 batch_frames=4, fps=FPS, crf=22, audio_range=None, audio_copy=False):
+        count = len(outputs)
+        width = max(size[0] for _, size in outputs)
+        self.offsets = np.cumsum([0] + [size[1] for _, size in outputs]).tolist()
+        cmd = [
+            ffmpeg_binary(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-vcodec", "rawvideo", "-s", f"{width}x{self.offsets[-1]}", "-pix_fmt", "rgb24",
+            "-r", str(fps), "-i", "-"
+        ]
+        graph = ["[0:v]split={}{}".format(count, "".join(f"[s{i}]" for i in range(count)))]
+        for i, (_, (w, h)) in enumerate(outputs):
+            vfr = f",{VFR_FILTER}" if variable_frame_rate else ""
+            graph.append(f"[s{i}]crop={w}:{h}:0:{self.offsets[i]}{vfr}[v{i}]")
+        if audio_path:
+            if audio_range:
+                cmd += ["-ss", f"{audio_range[0]:.3f}", "-t", f"{audio_range[1] - audio_range[0]:.3f}"]
+            cmd += ["-i", audio_path]
+            if not audio_copy: graph.append("[1:a:0]asplit={}{}".format(count, "".join(f"[a{i}]" for i in range(count))))
+        cmd += ["-filter_complex", ";".join(graph)]
+        output_threads = max(1, (threads or os.cpu_count() or 1) // count)
+        for i, (path, _) in enumerate(outputs):
+            cmd += ["-map", f"[v{i}]"]
+            if audio_path: cmd += ["-map", "1:a:0", "-c:a", "copy"] if audio_copy else ["-map", f"[a{i}]", "-c:a", "aac"]
+            cmd += ["-c:v", "libx264", "-preset", preset, "-threads", str(output_threads),
+                    "-crf", str(crf), "-pix_fmt", "yuv420p"]
+            if variable_frame_rate: cmd += ["-vsync", "vfr"]
+            cmd.append(path)
+        self.output_paths = [path for path, _ in outputs]
+        # 较窄的规格右侧留空，清零后不会把未初始化的内存送进管道
+        self._start(cmd, np.zeros((batch_frames, self.offsets[-1], width, 3), dtype=np.uint8))
+
+    def write_frame(self, frames):
+        """frames 为与 outputs 一一对应的各规格帧。"""
+        stack_frames(self._batch[self._pending], frames, self.offsets)
+        self._pending += 1
+        if self._pending == len(self._batch):
+            self._flush()
+
+
+def encode_outputs_with_ffmpeg(make_frames, frame_count, outputs, audio_path=None, threads=None,
+                               variable_frame_rate=False, fps=FPS, preset="medium", crf=22, audio_range=None,
+                               audio_copy=False, profiler=None):
+    """一次时间轴遍历同时编码多个输出：make_frames(t) 返回与 outputs 一一对应的帧列表。"""
+    profiler = profiler or RenderProfiler(enabled=False)
+    encoder = FFmpegMultiOutputEncoder(outputs, audio_path, threads, preset, variable_frame_rate,
+                                       fps=fps, crf=crf, audio_range=audio_range, audio_copy=audio_copy)
+    try:
+        for n in range(frame_count):
+            frames = make_frames(n / fps)
+            with profiler.span("编码写入"):
+                encoder.write_frame(frames)
+    except BaseException:
+        encoder.abort()
+        raise
+    encoder.close()
+
+
+def encode_with_ffmpeg(make_frame, frame_count, output_path, video_size, audio_path=None, threads=None,
+                       variable_frame_rate=False, logger="bar", fps=FPS, preset="medium", crf=22,
+                       audio_range=None, profiler=None, audio_copy=False, scratch_dir=None):
+    profiler = profiler or RenderProfiler(enabled=False)
+    encoder = FFmpegPipeEncoder(output_path, video_size, audio_path, threads, preset, variable_frame_rate,
+                                fps=fps, crf=crf, audio_range=audio_range, audio_copy=audio_copy)
+    try:
+        for n in range(frame_count):
+            frame = make_frame(n / fps)
+            with profiler.span("编码写入"):  # 管道写满时会阻塞，包含等待 x264 的时间
+                encoder.write_frame(frame)
+    except BaseException:
+        encoder.abort()
+        raise
+    encoder.close()
+
+
+def encode_with_moviepy(make_frame, frame_count, output_path, video_size, audio_path=None, threads=None,
+                        variable_frame_rate=False, logger="bar", fps=FPS, preset="medium", crf=22,
+                        audio_range=None, profiler=None, audio_copy=False, scratch_dir=None):
+    """audio_copy 时把源文件交给 moviepy 的 ffmpeg 写入进程直接封装音频流，不经 AudioFileClip 解码；
+    否则转码为 AAC，临时音轨写在 scratch_dir（默认新建一个临时目录）中。"""
+    from moviepy.video.VideoClip import VideoClip
+    from moviepy.audio.io.AudioFileClip import AudioFileClip
+    if profiler and profiler.enabled:
+        # 写帧发生在 moviepy 内部，两次取帧之间的时间就是 moviepy 的转换开销加上写入 ffmpeg 的时间
+        frame_source, returned = make_frame, None
+
+        def make_frame(t):
+            nonlocal returned
+            if returned is not None: profiler.record("编码写入", returned, time.perf_counter_ns())
+            frame = frame_source(t)
+            returned = time.perf_counter_ns()
+            return frame
+    # 时长少半帧，避免浮点误差让 moviepy 多写出一帧
+    clip = VideoClip(make_frame, duration=(frame_count - 0.5) / fps).set_fps(fps)
+    copy_audio = bool(audio_path and audio_copy and not audio_range)
+    audio_clip = AudioFileClip(audio_path) if audio_path and not copy_audio else None
+    try:
+        # moviepy 默认把临时音轨写在输出文件旁边，中途失败时不会删除；改放到任务的临时目录
+        with nullcontext(scratch_dir) if scratch_dir else scratch_directory("lyric_moviepy_") as work_dir:
+            if audio_clip:
+                clip = clip.set_audio(audio_clip.subclip(*audio_range) if audio_range else audio_clip)
+            clip.write_videofile(
+                output_path, codec="libx264", audio=audio_path if copy_audio else bool(audio_clip),
+                audio_codec="aac", temp_audiofile=os.path.join(work_dir, "audio.m4a"),
+                threads=threads or os.cpu_count(), preset=preset,
+                ffmpeg_params=x264_params(variable_frame_rate, crf), logger=logger
+            )
+    finally:
+        _close_clips([audio_clip, clip])
+
+
+ENCODER_BACKENDS = {"ffmpeg": encode_with_ffmpeg, "moviepy": encode_with_moviepy}
+
+
+def encode_video(encoder, make_frame, frame_count, output_path, video_size, **kwargs):
+    """按名称选择编码后端；ffmpeg 管道无法启动时回退到 moviepy。"""
+    if encoder not in ENCODER_BACKENDS:
+        raise ValueError(f"未知的编码后端: {encoder}")
+    if encoder == "ffmpeg":
+        try:
+            return encode_with_ffmpeg(make_frame, frame_count, output_path, video_size, **kwargs)
+        except FileNotFoundError:
+            print("未找到 ffmpeg 可执行文件，改用 moviepy 编码。")
+            encoder = "moviepy"
+    return ENCODER_BACKENDS[encoder](make_frame, frame_count, output_path, video_size, **kwargs)
+
+
+# --- 5. 分段并行渲染 ---
+_worker_cancel_event = None  # 进程池子进程共享的取消标志，由 init_render_worker 在子进程启动时设置
+
+
+def init_render_worker(cancel_event):
+    """进程池的 initializer：同步原语只能在创建子进程时传入，不能作为任务参数提交。"""
+    global _worker_cancel_event
+    _worker_cancel_event = cancel_event
+
+
+def worker_cancelled():
+    return _worker_cancel_event is not None and _worker_cancel_event.is_set()
+
+
+def _render_segment(lyrics_path, cover_path, duration, start_frame, end_frame, segment_path, threads,
+                    variable_frame_rate=False, encoder="ffmpeg", video_size=OUTPUT_PROFILES[DEFAULT_PROFILE], plan=None,
+                    array_cache=None):
+    """子进程入口：按渲染计划重建渲染管线，只渲染 [start_frame, end_frame) 区间的画面（不含音频）。"""
+    compose_frame, clips = build_render_pipeline(lyrics_path, cover_path, duration, array_cache=array_cache,
+                                                 video_size=video_size, plan=plan)
+    offset = start_frame / FPS
+
+    def make_frame(t):
+        if worker_cancelled(): raise Cancelled("渲染已取消")
+        return compose_frame(offset + t)
+
+    try:
+        encode_video(encoder, make_frame, end_frame - start_frame, segment_path,
+                     compose_frame.video_size, threads=threads, variable_frame_rate=variable_frame_rate,
+                     logger=None)
+    finally:
+        _close_clips(clips)
+    return segment_path
+
+
+def _concat_segments(segment_paths, audio_path, output_path, work_dir, audio_copy=False):
+    """用 ffmpeg concat 无损拼接视频分段，并在同一进程中混入音频（audio_copy 时原样封装，否则转码为 AAC）。"""
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in segment_paths:
+            f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+    cmd = [
+        ffmpeg_binary(), "-y", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-i", list_path, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy",
+        "-c:a", "copy" if audio_copy else "aac", output_path
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise IOError(f"分段拼接失败: {result.stderr.decode('utf-8', 'ignore').strip()}")
+
+
+def _render_segments_parallel(audio_path, lyrics_path, cover_path, output_path, duration, segments, tracker,
+                              variable_frame_rate=False, encoder="ffmpeg", cancelled=None,
+                              video_size=OUTPUT_PROFILES[DEFAULT_PROFILE], audio_copy=False, scratch_dir=None,
+                              plan=None, array_cache=None):
+    """把时间轴切成若干分段，在进程池中并行渲染后拼接。cancelled() 为 True 时通知所有分段在当前帧后中止。
+    分段文件写在 scratch_dir（默认新建一个临时目录）中，随目录一起删除；各分段沿用 plan。"""
+    total_frames = int(np.ceil(duration * FPS))
+    segments = max(1, min(segments, total_frames))
+    bounds = np.linspace(0, total_frames, segments + 1).astype(int)
+    workers = min(segments, os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # 与 _render_frames_shared 相同，可能从 GUI 的工作线程调用，子进程用 spawn 启动
+    context = multiprocessing.get_context("spawn")
+    cancel_event = context.Event()
+    with nullcontext(scratch_dir) if scratch_dir else scratch_directory("lyric_segments_") as work_dir:
+        segment_paths = [os.path.join(work_dir, f"segment_{i:04d}.mp4") for i in range(segments)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_render_worker,
+                                 initargs=(cancel_event,)) as pool:
+            futures = {pool.submit(_render_segment, lyrics_path, cover_path, duration,
+                                   int(bounds[i]), int(bounds[i + 1]), segment_paths[i], threads,
+                                   variable_frame_rate, encoder, video_size, plan, array_cache): i
+                       for i in range(segments)}
+            pending, frames_done = set(futures), 0
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.1)
+                    if cancelled and cancelled(): raise Cancelled("渲染已取消")
+                    for future in done:
+                        future.result()
+                        i = futures[future]
+                        frames_done += int(bounds[i + 1] - bounds[i])
+                        tracker.update(frames_done, f"正在并行渲染: {segments - len(pending)}/{segments} 段已完成")
+            except BaseException:
+                # 取消或某一段出错时通知其余分段在当前帧后中止，不等它们渲染完
+                cancel_event.set()
+                for future in pending: future.cancel()
+                raise
+        tracker.report(95, "正在拼接分段并合成音频...", stage="concat")
+        _concat_segments(segment_paths, audio_path, output_path, work_dir, audio_copy)
+
+
+class SharedFrameRing:
+    """多个进程共用的帧环形缓冲：第 n 帧放在 shared_memory 的 n % slots 号槽位。
+    渲染进程 acquire(n) 后写入、publish(n)；写出端按帧序 wait_run、write_run 后归还槽位。
+    作为进程池的 initargs 传给子进程，只有创建者在 close() 时删除共享内存。"""
 
-        progress(10, "检测语言并加载字体...")
-        full_lyrics_text = " ".join([l['text'] for l in lyrics_data])
-        detected_lang = detect_language(full_lyrics_text)
-        fonts = load_fonts(detected_lang, "Fonts", FONT_SIZE_LYRIC, FONT_SIZE_SMALL)
-
-        progress(15, "创建视觉元素...")
-        background = create_dynamic_background(cover_path, duration, VIDEO_SIZE, 60)
-        cover = create_cover_clip(cover_path, duration, VIDEO_SIZE, (cover_size_w, cover_size_h),
-                                  (cover_pos_x, cover_pos_y), int(cover_size_w * 0.12))
-        lyrics = create_lyrics_clip(lyrics_data, duration, fonts, detected_lang, lyrics_config)
-
-        progress(20, "即将开始渲染...")
-
-        total_frames = int(duration * 24)
-
-        def make_final_frame(t):
-            current_frame = int(t * 24)
-            # 优化进度条：20%到95%分配给渲染过程
-            progress_val = 20 + int((current_frame / total_frames) * 75)
-            if current_frame % 24 == 0:  # 每秒更新一次状态，避免过于频繁
-                progress(progress_val, f"正在渲染: {current_frame}/{total_frames} 帧")
-
-            result = background.get_frame(t).astype(np.float32)
-            cover_frame = cover.get_frame(t)
-            alpha_cover = cover_frame[..., 3:4] / 255.0
-            result = cover_frame[..., :3] * alpha_cover + result * (1.0 - alpha_cover)
-            lyrics_frame = lyrics.get_frame(t)
-            alpha_lyrics = lyrics_frame[..., 3:4] / 255.0
-            result = lyrics_frame[..., :3] * alpha_lyrics + result * (1.0 - alpha_lyrics)
-
-            fade_in, fade_out = 1.5, 2.5
-            if t < fade_in:
-                result *= (t / fade_in)
-            elif t > duration - fade_out:
-                result *= max(0, (duration - t) / fade_out)
-            return np.clip(result, 0, 255).astype(np.uint8)
-
-        final_clip = mpy.VideoClip(make_final_frame, duration=duration).set_fps(24).set_audio(audio_clip)
-
-        progress(95, "正在合成音频并导出文件...")
-        final_clip.write_videofile(
-            output_path, codec="libx264", audio_codec="aac", threads=os.cpu_count(),
-            preset="medium", ffmpeg_params=["-crf", "22", "-pix_fmt", "yuv420p"]
-        )
-        progress(100, "视频合成成功！")
+    def __init__(self, frame_shape, slots, context=None, _attach=None):
+        self.frame_shape, self.slots = tuple(frame_shape), slots
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self._data_offset = -(-(slots + 3) * 8 // 64) * 64  # 头部之后按 64 字节对齐
+        self._owner = _attach is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=self._data_offset + slots * self.frame_bytes)
+            self._cond = (context or multiprocessing).Condition()
+        else:
+            name, self._cond = _attach
+            self._shm = shared_memory.SharedMemory(name=name)
+        buf = self._shm.buf
+        self._ready = np.ndarray((slots,), np.int64, buf)  # 各槽位当前存放的帧号，-1 表示空
+        self._counters = np.ndarray((3,), np.int64, buf, offset=slots * 8)  # 已写出帧数、渲染端等待、写出端等待
+        self._frames = np.ndarray((slots,) + self.frame_shape, np.uint8, buf, offset=self._data_offset)
+        if self._owner: self._ready[:] = -1
+
+    def __getstate__(self):
+        return {"frame_shape": self.frame_shape, "slots": self.slots, "_attach": (self._shm.name, self._cond)}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _wait(self, predicate, counter, check):
+        # 调用方持有锁；定时醒来运行 check()，由它抛出异常中止等待（取消、另一端出错）
+        if predicate(): return
+        self._counters[counter] += 1
+        while not predicate():
+            if check: check()
+            self._cond.wait(0.1)
+
+    def acquire(self, n, check=None):
+        """渲染端：等到第 n 帧的槽位空闲，返回该槽位的 ndarray 视图。"""
+        with self._cond:
+            self._wait(lambda: n - self._counters[0] < self.slots, 1, check)
+        return self._frames[n % self.slots]
+
+    def publish(self, n):
+        with self._cond:
+            self._ready[n % self.slots] = n
+            self._cond.notify_all()
+
+    def wait_run(self, n, limit, check=None):
+        """写出端：等到第 n 帧就绪，返回从 n 起连续就绪、在内存中也连续（不跨越环尾）的帧数，最多到第 limit 帧之前。"""
+        end = min(limit, n - n % self.slots + self.slots)
+        with self._cond:
+            self._wait(lambda: self._ready[n % self.slots] == n, 2, check)
+            count = 1
+            while n + count < end and self._ready[(n + count) % self.slots] == n + count:
+                count += 1
+        return count
+
+    def write_run(self, n, count, write):
+        """把第 n 帧起的 count 个槽位作为一段连续字节交给 write（如编码器的 write_raw），随后归还这些槽位。"""
+        begin = self._data_offset + n % self.slots * self.frame_bytes
+        with self._shm.buf[begin:begin + count * self.frame_bytes] as view:
+            write(view)
+        with self._cond:
+            self._counters[0] = n + count
+            self._cond.notify_all()
+
+    def stats(self):
+        frames, producer_waits, writer_waits = (int(v) for v in self._counters)
+        return {"slots": self.slots, "slot_bytes": self.frame_bytes, "frames": frames,
+                "slot_reuses": max(0, frames - self.slots), "producer_waits": producer_waits,
+                "writer_waits": writer_waits}
+
+    def close(self):
+        self._ready = self._counters = self._frames = None  # 先释放对共享内存的引用，否则无法关闭
+        self._shm.close()
+        if self._owner: self._shm.unlink()
+
+
+RING_BLOCK_FRAMES = 4  # 渲染进程每次领取的连续帧数，组内的静止帧可以复用
+RING_MAX_BYTES = 512 * 1024 * 1024  # 帧环占用的共享内存上限（至少保证每个进程有一组槽位）
+_worker_ring = None
+
+
+def init_ring_worker(cancel_event, ring):
+    global _worker_ring
+    init_render_worker(cancel_event)
+    _worker_ring = ring
+
+
+def _render_ring_frames(worker_index, workers, lyrics_path, cover_path, duration, layouts, offsets, start,
+                        fps, frame_count, plan=None, array_cache=None):
+    """子进程入口：按 RING_BLOCK_FRAMES 帧一组轮流领取帧，合成后拷进共享帧环中该帧的槽位。"""
+    compose_frames, clips = build_render_pipelines(lyrics_path, cover_path, duration, layouts,
+                                                   array_cache=array_cache, plan=plan)
+    ring = _worker_ring
+
+    def check():
+        if worker_cancelled(): raise Cancelled("渲染已取消")
+
+    try:
+        for first in range(worker_index * RING_BLOCK_FRAMES, frame_count, workers * RING_BLOCK_FRAMES):
+            for n in range(first, min(first + RING_BLOCK_FRAMES, frame_count)):
+                check()
+                frames = [compose_frame(start + n / fps) for compose_frame in compose_frames]
+                stack_frames(ring.acquire(n, check), frames, offsets)
+                ring.publish(n)
     finally:
-        for clip in [audio_clip, background, cover, lyrics, final_clip]:
-            if clip:
-                try:
-                    clip.close()
-                except Exception:
-                    pass
+        _close_clips(clips)
+
+
+def _render_frames_shared(audio_path, lyrics_path, cover_path, outputs, layouts, duration, workers, tracker,
+                          start=0.0, fps=FPS, threads=None, variable_frame_rate=False, cancelled=None, plan=None,
+                          array_cache=None, **options):
+    """多个渲染进程合成同一段时间轴，经共享帧环交给同一个 ffmpeg 进程编码，返回帧环统计。"""
+    frame_count = tracker.total_frames
+    if len(outputs) == 1:
+        (path, size), = outputs
+        encoder = FFmpegPipeEncoder(path, size, audio_path, threads, variable_frame_rate=variable_frame_rate,
+                                    fps=fps, **options)
+    else:
+        encoder = FFmpegMultiOutputEncoder(outputs, audio_path, threads, variable_frame_rate=variable_frame_rate,
+                                           fps=fps, **options)
+    group = workers * RING_BLOCK_FRAMES
+    slots = max(group, min(2 * group, RING_MAX_BYTES // int(np.prod(encoder.frame_shape))))
+    # 调用方可能在 GUI 的工作线程中，fork 出的子进程可能继承其他线程持有的锁，因此用 spawn
+    context = multiprocessing.get_context("spawn")
+    ring = SharedFrameRing(encoder.frame_shape, slots, context)
+    cancel_event = context.Event()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_ring_worker,
+                                 initargs=(cancel_event, ring)) as pool:
+            futures = [pool.submit(_render_ring_frames, i, workers, lyrics_path, cover_path, duration, layouts,
+                                   encoder.offsets, start, fps, frame_count, plan, array_cache)
+                       for i in range(workers)]
+
+            def check():
+                if cancelled and cancelled(): raise Cancelled("渲染已取消")
+                for future in futures:
+                    if future.done(): future.result()
+
+            try:
+                n = 0
+                while n < frame_count:
+                    count = ring.wait_run(n, frame_count, check)
+                    ring.write_run(n, count, encoder.write_raw)
+                    n += count
+                    if n // fps > (n - count) // fps or n == frame_count:
+                        tracker.update(n, f"正在渲染（{workers} 个进程）")
+                for future in futures: future.result()
+            except BaseException:
+                cancel_event.set()
+                raise
+    except BaseException:
+        encoder.abort()
+        raise
+    finally:
+        stats = ring.stats()
+        ring.close()
+    encoder.close()
+    return stats
+
+
+# --- 6. 主生成函数 ---
+PREVIEW_FPS = 12
+PREVIEW_PRESET = "ultrafast"
+PREVIEW_CRF = 30
+
+
+def format_eta(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class RenderProgress:
+    """渲染进度通道：同时驱动 (百分比, 消息) 回调与结构化事件（stage、percent、message、帧数、fps、eta_seconds）回调。"""
+
+    def __init__(self, total_frames, progress_callback=None, on_progress=None, low=20, high=95):
+        self.total_frames = total_frames
+        self.progress_callback = progress_callback
+        self.on_progress = on_progress
+        self.low, self.high = low, high
+        self.started = self._last_time = time.perf_counter()
+        self._last_frames = 0
+
+    def report(self, percent, message, stage="prepare", **detail):
+        if self.progress_callback: self.progress_callback(percent, message)
+        if self.on_progress: self.on_progress(dict(stage=stage, percent=percent, message=message, **detail))
+
+    def start(self):
+        self.started = self._last_time = time.perf_counter()
+        self._last_frames = 0
+
+    def update(self, frames_done, label="正在渲染"):
+        frames_done = min(frames_done, self.total_frames)
+        now = time.perf_counter()
+        current_fps = (frames_done - self._last_frames) / max(now - self._last_time, 1e-6)
+        average_fps = frames_done / max(now - self.started, 1e-6)
+        eta = (self.total_frames - frames_done) / average_fps if average_fps > 0 else None
+        self._last_time, self._last_frames = now, frames_done
+        percent = self.low + int(frames_done / self.total_frames * (self.high - self.low))
+        message = f"{label}: {frames_done}/{self.total_frames} 帧, {current_fps:.1f} fps"
+        if eta is not None: message += f", 预计剩余 {format_eta(eta)}"
+        self.report(percent, message, stage="render", frames_done=frames_done, total_frames=self.total_frames,
+                    fps=current_fps, eta_seconds=eta)
+
+
+def generate_music_video(audio_path, lyrics_path, cover_path, output_path, progress_callback=None,
+                         parallel_segments=1, variable_frame_rate=False, encoder="ffmpeg",
+                         time_range=None, preview=None, threads=None, profile=False, trace_path=None,
+                         on_progress=None, cancelled=None, profiles=None, audio_passthrough=True, render_workers=1,
+                         render_plan=True, plan_path=None, array_cache=None, segmenter=None):
+    """生成歌词视频，返回渲染统计（帧数、耗时、帧率、首帧耗时、各输出文件路径等）。
+    返回值的 "sprite_cache" 与 "blend" 为各规格的精灵缓存和歌词混合统计，顺序与 "outputs" 相同。
+
+    parallel_segments > 1 时分段并行渲染；render_workers > 1 时多个进程经共享帧环合成同一段时间轴；
+    variable_frame_rate 输出可变帧率；encoder 为 "ffmpeg" 或 "moviepy"；profiles 为输出规格列表（仅 ffmpeg）。
+    time_range=(start, end) 只渲染这一段；preview 为草稿模式的缩放比例；threads 限制 x264 线程数。
+    audio_passthrough 在编码允许时直接复制音频流；render_plan 在输出旁保存并沿用渲染计划，plan_path 另行指定其位置。
+    profile / trace_path 记录各阶段耗时；on_progress 接收 RenderProgress 事件；cancelled() 为 True 时中止并抛出 Cancelled。
+    array_cache（ArrayDiskCache）与 segmenter（SegmentationCache）替换 CACHE_DIR 中的默认缓存，如基准测试各用一份空缓存。
+    """
+    called = time.perf_counter()
+    tracker = RenderProgress(1, progress_callback, on_progress)
+    progress = tracker.report
+    sizes = [resolve_profile(p) for p in profiles] if profiles else [OUTPUT_PROFILES[DEFAULT_PROFILE]]
+    output_paths = profile_output_paths(output_path, profiles)
+    if len(sizes) > 1 and encoder != "ffmpeg":
+        raise ValueError("多规格输出只支持 ffmpeg 编码后端。")
+
+    def check_cancelled():
+        if cancelled and cancelled(): raise Cancelled("渲染已取消")
+
+    clips = []
+    writing = False  # 开始写输出文件后，失败或取消时需要删除不完整的文件
+    with scratch_directory() as work_dir:
+        try:
+            progress(0, "准备中...")
+            audio_info = probe_audio(audio_path)
+            duration = audio_info["duration"]
+            audio_copy = bool(audio_passthrough and audio_info["codec"] in MP4_AUDIO_COPY_CODECS)
+            total_frames = tracker.total_frames = int(np.ceil(duration * FPS))
+            started = time.perf_counter()
+            check_cancelled()
+
+            layouts = [render_layout(preview or 1.0, size) for size in sizes]
+            plan_path = plan_path or render_plan_path(output_path)
+            base_plan = load_render_plan(plan_path, lyrics_path, cover_path, duration) if render_plan else None
+            plan = compile_render_plan(lyrics_path, cover_path, duration, layouts, progress, base=base_plan,
+                                       segmenter=segmenter)
+            if render_plan and not preview and plan is not base_plan:
+                save_render_plan(plan, plan_path)
+            check_cancelled()
+
+            if parallel_segments and parallel_segments > 1 and not (time_range or preview) and len(sizes) == 1:
+                progress(20, f"即将开始分段渲染（{parallel_segments} 段）...")
+                writing = True
+                tracker.start()
+                _render_segments_parallel(audio_path, lyrics_path, cover_path, output_path, duration,
+                                          parallel_segments, tracker, variable_frame_rate, encoder, cancelled,
+                                          video_size=sizes[0], audio_copy=audio_copy, scratch_dir=work_dir,
+                                          plan=plan, array_cache=array_cache)
+                elapsed = time.perf_counter() - started
+                progress(100, "视频合成成功！", stage="done")
+                return {"frames": total_frames, "seconds": elapsed, "fps": total_frames / elapsed,
+                        "outputs": output_paths}
+
+            fps, options = FPS, {"audio_copy": audio_copy}
+            if preview:
+                fps = PREVIEW_FPS
+                options.update(preset=PREVIEW_PRESET, crf=PREVIEW_CRF)
+            start, end = 0.0, duration
+            if time_range:
+                start, end = max(0.0, time_range[0]), min(duration, time_range[1])
+                if end <= start: raise ValueError("预览区间无效：结束时间必须晚于开始时间。")
+                options.update(audio_range=(start, end), audio_copy=False)
+            total_frames = tracker.total_frames = max(1, int(np.ceil((end - start) * fps)))
+
+            profiler = RenderProfiler(enabled=bool(profile or trace_path), trace=bool(trace_path))
+            if render_workers and render_workers > 1 and encoder == "ffmpeg":
+                progress(20, f"即将开始多进程渲染（{render_workers} 个进程）...")
+                outputs = [(path, layout["video_size"]) for path, layout in zip(output_paths, layouts)]
+                writing = True
+                tracker.start()
+                ring_stats = _render_frames_shared(audio_path, lyrics_path, cover_path, outputs, layouts, duration,
+                                                   render_workers, tracker, start, fps, threads,
+                                                   variable_frame_rate, cancelled, plan, array_cache, **options)
+                elapsed = time.perf_counter() - started
+                progress(100, "视频合成成功！", stage="done")
+                return {"frames": total_frames, "seconds": elapsed, "fps": total_frames / elapsed,
+                        "outputs": output_paths, "ring": ring_stats}
+            compose_frames, clips = build_render_pipelines(lyrics_path, cover_path, duration, layouts, progress,
+                                                           array_cache, profiler, plan)
+
+            check_cancelled()
+            progress(20, "即将开始渲染...")
+            first_frame_seconds = None
+            frames_done = 0
+
+            def make_final_frames(t):
+                nonlocal first_frame_seconds, frames_done
+                check_cancelled()
+                if first_frame_seconds is None:
+                    first_frame_seconds = time.perf_counter() - called
+                with profiler.span("合成帧"):
+                    frames = [compose_frame(start + t) for compose_frame in compose_frames]
+                frames_done += 1
+                # 20%到95%分配给渲染过程，每渲染一秒的画面报告一次，避免过于频繁
+                if frames_done % fps == 0 or frames_done == total_frames:
+                    tracker.update(frames_done)
+                return frames
+
+            started = time.perf_counter()
+            writing = True
+            tracker.start()
+            if len(compose_frames) == 1:
+                encode_video(encoder, lambda t: make_final_frames(t)[0], total_frames, output_path,
+                             compose_frames[0].video_size, audio_path=audio_path, threads=threads,
+                             variable_frame_rate=variable_frame_rate, fps=fps, profiler=profiler,
+                             scratch_dir=work_dir, **options)
+            else:
+                outputs = [(path, f.video_size) for path, f in zip(output_paths, compose_frames)]
+                encode_outputs_with_ffmpeg(make_final_frames, total_frames, outputs, audio_path=audio_path,
+                                           threads=threads, variable_frame_rate=variable_frame_rate, fps=fps,
+                                           profiler=profiler, **options)
+            elapsed = time.perf_counter() - started
+            result = {"frames": total_frames, "seconds": elapsed, "fps": total_frames / elapsed,
+                      "first_frame_seconds": first_frame_seconds, "outputs": output_paths,
+                      "sprite_cache": [compose_frame.sprite_cache.stats() for compose_frame in compose_frames],
+                      "blend": [dict(compose_frame.blend_stats) for compose_frame in compose_frames]}
+            message = "视频合成成功！"
+            if profiler.enabled:
+                result["profile"] = profiler.summary()
+                message += "\n" + profiler.summary_text()
+                print(profiler.summary_text())
+                if trace_path:
+                    profiler.dump_trace(trace_path)
+                    print(f"耗时追踪已写入 {trace_path}")
+            progress(100, message, stage="done")
+            return result
+        except BaseException as e:
+            for path in output_paths if writing else ():
+                if os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            if isinstance(e, Cancelled): progress(tracker.low, "渲染已取消，已删除未完成的输出文件。", stage="cancelled")
+            raise
+        finally:
+            _close_clips(clips)
+
+
+# --- 7. 批量调度 ---
+X264_THREADS_PER_RENDER = 2
+
+
+def plan_core_budget(task_count, core_budget=None, x264_threads=X264_THREADS_PER_RENDER):
+    """把核心预算分给并发渲染：每个渲染占一个核心生成画面，另加 x264_threads 个编码线程。
+
+    返回 (并发渲染数, 每个渲染的 x264 线程数)。核心不够时退化为单个渲染独占全部核心。
+    """
+    core_budget = max(1, core_budget or os.cpu_count() or 1)
+    workers = max(1, min(task_count, core_budget // (1 + x264_threads)))
+    if workers == 1:
+        return 1, core_budget
+    return workers, max(1, core_budget // workers - 1)
+
+
+def run_render_task(index, task, threads, events):
+    """进程池入口：渲染一个批量任务，把 ("started", i) 与 ("progress", i, 百分比, 消息) 事件放进 events 队列。
+    异常原样抛给调度方，由其按任务单独处理，不影响其他任务。
+    进程池用 init_render_worker 设置取消标志后，标志置位时渲染在当前帧后中止。"""
+    events.put(("started", index))
+    generate_music_video(task['audio_path'], task['lyrics_path'], task['cover_path'], task['output_path'],
+                         progress_callback=lambda p, m: events.put(("progress", index, p, m)),
+                         threads=threads, cancelled=worker_cancelled, **task.get('render_options', {}))
+
+
+# --- 8. 增量渲染清单 ---
+HISTORY_PATH = "history.json"
+
+
+def file_fingerprint(path, known=None):
+    """返回文件的 {path, size, mtime_ns, sha256}。大小和修改时间与 known 中的记录一致时直接沿用其哈希，不再读文件。"""
+    st = os.stat(path)
+    if known and known.get("size") == st.st_size and known.get("mtime_ns") == st.st_mtime_ns:
+        return dict(known, path=path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def load_render_history(history_path=HISTORY_PATH):
+    try:
+        with open(history_path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        return history if isinstance(history, list) else []
+    except (OSError, ValueError):
+        return []
+
+
+def _known_inputs(history):
+    known = {}
+    for entry in reversed(history):  # 记录按时间倒序，新记录覆盖旧记录
+        for record in entry.get("inputs", {}).values():
+            known[record["path"]] = record
+    return known
+
+
+def compute_render_key(task, history=(), fonts_dir="Fonts"):
+    """根据音频、歌词、封面、字体文件的内容哈希与渲染设置计算任务的内容键。只读文件字节，不解码任何媒体。
+
+    返回 (键, 输入文件指纹)。
+    """
+    known = _known_inputs(history)
+    inputs = {name: file_fingerprint(task[key], known.get(task[key]))
+              for name, key in (("audio", "audio_path"), ("lyrics", "lyrics_path"), ("cover", "cover_path"))}
+    with open(task['lyrics_path'], "r", encoding="utf-8", errors="ignore") as f:
+        lang = detect_language(re.sub(r"\[[^\]]*\]", "", f.read()))
+    fonts = {}
+    for style, path in font_paths(lang, fonts_dir).items():
+        # 字体文件名也计入设置：换用另一套字体或字体缺失时键都会变化
+        fonts[style] = os.path.basename(path) if os.path.exists(path) else None
+        if fonts[style]:
+            inputs[f"font_{style}"] = file_fingerprint(path, known.get(path))
+    settings = {"version": RENDER_VERSION, "options": task.get('render_options', {}), "fonts": fonts}
+    payload = json.dumps({"inputs": {k: v["sha256"] for k, v in inputs.items()}, "settings": settings},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest(), inputs
+
+
+def task_output_paths(task):
+    """任务的全部输出文件（多个输出规格时每个规格一个文件）。"""
+    return profile_output_paths(task['output_path'], task.get('render_options', {}).get('profiles'))
+
+
+def find_current_render(task, key, history):
+    """全部输出文件都存在、大小与记录一致且内容键相同时返回第一个输出的记录，否则返回 None。"""
+    records = {entry.get("file_path"): entry for entry in reversed(history)}
+    current = []
+    for output_path in task_output_paths(task):
+        try:
+            size = os.path.getsize(output_path)
+        except OSError:
+            return None
+        entry = records.get(output_path)
+        if not entry or entry.get("render_key") != key or entry.get("size") != size:
+            return None
+        current.append(entry)
+    return current[0]
+
+
+def record_render(task, key, inputs, history_path=HISTORY_PATH):
+    """把成功的渲染写进 history.json（最新的在最前），每个输出文件一条记录，同一输出路径只保留一条。"""
+    output_paths = task_output_paths(task)
+    history = [entry for entry in load_render_history(history_path)
+               if entry.get("file_path") not in output_paths]
+    for output_path in reversed(output_paths):
+        history.insert(0, {
+            "song_name": task.get('name', os.path.splitext(os.path.basename(task['output_path']))[0]),
+            "file_path": output_path,
+            "timestamp": datetime.now().isoformat(),
+            "size": os.path.getsize(output_path),
+            "render_key": key,
+            "inputs": inputs
+        })
+    tmp_path = history_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(history, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, history_path)
+
+
+# --- 9. 波形峰值金字塔 ---
+WAVEFORM_RATE = 4000  # 解码波形时的采样率
+WAVEFORM_BIN = 16  # 底层每个峰值覆盖的采样数（4 毫秒）
+WAVEFORM_TOP_BINS = 256  # 金字塔逐层减半，直到不超过此长度
+
+
+def stream_waveform_peaks(audio_path, chunk_seconds=10, cancelled=None):
+    """用 ffmpeg 把音频流式解码为单声道 16 位 PCM，逐块归约成 (n, 2) 的 int16 [最小值, 最大值]。
+
+    内存占用只与块大小有关，与歌曲长度无关；cancelled() 返回 True 时结束解码并抛出 Cancelled。
+    """
+    frame_bytes = WAVEFORM_BIN * 2
+    chunk_bytes = WAVEFORM_RATE * chunk_seconds // WAVEFORM_BIN * frame_bytes
+    process = subprocess.Popen([
+        ffmpeg_binary(), "-v", "error", "-i", audio_path, "-vn",
+        "-ac", "1", "-ar", str(WAVEFORM_RATE), "-f", "s16le", "pipe:1"
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    peaks, carry = [], b""
+    try:
+        for data in iter(lambda: process.stdout.read(chunk_bytes), b""):
+            if cancelled and cancelled(): raise Cancelled()
+            data = carry + data
+            usable = len(data) // frame_bytes * frame_bytes
+            carry = data[usable:]
+            if usable:
+                samples = np.frombuffer(data[:usable], dtype=np.int16).reshape(-1, WAVEFORM_BIN)
+                peaks.append(np.stack([samples.min(axis=1), samples.max(axis=1)], axis=1))
+        tail = np.frombuffer(carry[:len(carry) // 2 * 2], dtype=np.int16)
+        if tail.size: peaks.append(np.array([[tail.min(), tail.max()]], dtype=np.int16))
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg 解码音频失败: {error.decode('utf-8', 'replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return np.concatenate(peaks) if peaks else np.zeros((0, 2), dtype=np.int16)
+
+
+def _halve_peaks(peaks):
+    if len(peaks) % 2: peaks = np.concatenate([peaks, peaks[-1:]])
+    pairs = peaks.reshape(-1, 2, 2)
+    return np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1)
+
+
+def load_waveform_pyramid(audio_path, cache=None, cancelled=None):
+    """返回波形峰值金字塔（列表）：第 0 层每 WAVEFORM_BIN 个采样一个 [最小值, 最大值]，之后每层长度减半。
+
+    耗时的是解码，因此底层按音频内容哈希存入磁盘缓存，换一首再换回来时不必重新解码；上面各层由底层归约，不到 1 毫秒。
+    """
+    cache = cache or ArrayDiskCache()
+    digest = file_fingerprint(audio_path)["sha256"]
+    base = cache.get_or_create(("waveform", digest, WAVEFORM_RATE, WAVEFORM_BIN),
+                               lambda: stream_waveform_peaks(audio_path, cancelled=cancelled))
+    levels = [base]
+    while len(levels[-1]) > WAVEFORM_TOP_BINS:
+        levels.append(_halve_peaks(levels[-1]))
+    return levels